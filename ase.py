@@ -1,13 +1,21 @@
 import argparse
+import heapq
+import json
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from tqdm import tqdm
-
+import client
 import db
-from chunking import chunkify_code
-from util import hexdigest, get_indexable_files, infer_language, validate_language
+import manifest
+import metrics
+from lexical import fuse
+import pipeline
+from ignore import IGNORE_FILES
+from util import (MAX_FILE_BYTES, IndexableFilter, hexdigest, get_indexable_files, is_binary, text_hash,
+                  validate_language)
 
 
 def relativize(full_path, base_path):
@@ -19,9 +27,20 @@ def relativize(full_path, base_path):
         base_path (str): The base path to make the full_path relative to.
     
     Returns:
-        str: The relative path.
+        str: The relative path, or the full path if it isn't under base_path (e.g. a
+        result from another collection).
     """
-    return str(Path(full_path).resolve().relative_to(base_path))
+    try:
+        return str(Path(full_path).resolve().relative_to(base_path))
+    except ValueError:
+        return full_path
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--profile', action='store_true',
+                        help='Print the time, count and bytes of each stage (walk, hash, chunk, embed, database) at the end.')
+    parser.add_argument('--metrics', type=str, metavar='FILE',
+                        help='Also write the metrics, and a trace viewable in chrome://tracing or Perfetto, to FILE as JSON.')
+
 
 def parse_arguments():
     """
@@ -49,19 +68,75 @@ def parse_arguments():
     # Adjusted parser_index to make languages an optional argument
     parser_index.add_argument('--languages', nargs='*',
                               help='Optional list of programming languages to filter the search.')
+    parser_index.add_argument('--max-file-size', type=int, default=MAX_FILE_BYTES, metavar='BYTES',
+                              help='Skip files larger than this (default: %(default)s).')
+    parser_index.add_argument('--walk-workers', type=int, default=1,
+                              help='Number of threads scanning directories for files (default: 1).')
+    parser_index.add_argument('--resync', action='store_true',
+                              help='Reload the local manifest of indexed files from the database first.')
+    parser_index.add_argument('--watch', action='store_true',
+                              help='After indexing, keep watching for changes and re-index changed files until interrupted.')
+    parser_index.add_argument('--chunk-workers', type=int, default=os.cpu_count() or 1,
+                              help='Number of threads reading and chunking files (default: number of CPUs).')
+    parser_index.add_argument('--chunk-processes', type=int, default=0,
+                              help='Parse and chunk files in this many worker processes instead of threads (default: 0, use threads).')
+    parser_index.add_argument('--embed-workers', type=int, default=4,
+                              help='Number of embedding requests to keep in flight (default: 4).')
+    parser_index.add_argument('--insert-workers', type=int, default=32,
+                              help='Number of files being written to the database at once; their writes are packed '
+                                   'into shared requests (default: 32).')
+    add_metrics_arguments(parser_index)
 
     # Create the parser for the "search" command
     parser_search = subparsers.add_parser('search', help='Search for code files in the database.')
-    parser_search.add_argument('path_to_code', type=str, nargs='?', default=os.getcwd(),
+    parser_search.add_argument('path_to_code', type=str, nargs='?',
                                help='Path to the directory where code files are located. Defaults to current working directory.')
-    parser_search.add_argument('query', type=str, help='Search query.')
+    parser_search.add_argument('query', type=str, nargs='?', help='Search query.')
     parser_search.add_argument('--collection', type=str, help='Name of the collection to use. Defaults to directory name.')
+    parser_search.add_argument('--collections', type=str, metavar='NAMES',
+                               help='Search several collections at once: a comma-separated list of names or glob patterns '
+                                    '(e.g. "api,web-*").  Results are merged by score and labeled with their collection.')
     parser_search.add_argument('-l', '--files-with-matches', action='store_true', help='Print only the names of files containing matches.')
     parser_search.add_argument('-m', '--max-count', type=int, default=5, help='Return a maximum of NUM matches (default: 5)', metavar='NUM')
+    parser_search.add_argument('--mode', choices=['vector', 'lexical', 'hybrid'], default='vector',
+                               help='vector: embedding similarity (default); lexical: local BM25 over identifiers, '
+                                    'with no embedding call; hybrid: both, merged with reciprocal rank fusion.')
+    parser_search.add_argument('--nprobe', type=int, help='Number of ANN index partitions to scan with the local backend; higher is slower but more accurate.')
+    parser_search.add_argument('--exact', action='store_true', help='Force an exact (brute-force) search with the local backend.')
+    parser_search.add_argument('--no-server', action='store_true', help='Search in-process even if `ase serve` is running.')
+    parser_search.add_argument('--batch', type=str, metavar='FILE',
+                               help='Run every query in FILE (- for stdin), one per line or as JSONL objects with "query" '
+                                    'and optional "id", and write one JSON line of results per query.')
+    parser_search.add_argument('--search-workers', type=int, default=8,
+                               help='Number of concurrent lookups with --batch (default: %(default)s).')
+    add_metrics_arguments(parser_search)
+
+    # Create the parser for the "serve" command
+    parser_serve = subparsers.add_parser('serve', help='Run a daemon that keeps clients warm and answers searches.')
+    parser_serve.add_argument('--socket', type=str, default=client.socket_path(),
+                              help='Unix socket to listen on (default: %(default)s).')
+
+    # Create the parser for the "eval" command
+    parser_eval = subparsers.add_parser('eval', help='Measure the search recall of compact (truncated or quantized) vector storage.',
+                                        description='Measure the search recall of compact (truncated or quantized) vector '
+                                                    'storage against the full-precision vectors of a local collection.  '
+                                                    'A compact collection only has them if it was built with ASE_RERANK=1.')
+    parser_eval.add_argument('path_to_code', type=str, nargs='?', default=os.getcwd(),
+                             help='Path to the directory where code files are located. Defaults to current working directory.')
+    parser_eval.add_argument('--collection', type=str, help='Name of the collection to use. Defaults to directory name.')
+    parser_eval.add_argument('--dims', type=int, nargs='*', default=[0, 512, 256, 128],
+                             help='Truncated dimensions to evaluate; 0 keeps all of them (default: %(default)s).')
+    parser_eval.add_argument('--quantization', nargs='*',
+                             help='Quantizations to evaluate: float32, int8 and/or binary (default: all).')
+    parser_eval.add_argument('-k', '--limit', type=int, default=10, help='Number of results per query (default: %(default)s).')
+    parser_eval.add_argument('--queries', type=int, default=100, help='Number of sampled chunks to query with (default: %(default)s).')
+    parser_eval.add_argument('--rows', type=int, default=100000, help='Evaluate on at most this many chunks (default: %(default)s).')
 
     # Create the parser for the "debug-index" command
     parser_debug_index = subparsers.add_parser('debug-index', help='List all indexed files with their hexdigest.')
     parser_debug_index.add_argument('--collection', type=str, help='Name of the collection to use. Defaults to directory name.')
+    parser_debug_index.add_argument('--resync', action='store_true',
+                                    help='Reload the local manifest of indexed files from the database first.')
     parser_debug_index.add_argument('path_to_code', type=str, nargs='?', default=os.getcwd(),
                                     help='Path to the directory where code files are located. Defaults to current working directory.')
 
@@ -86,6 +161,13 @@ def parse_arguments():
     if args.command is None:
         parser.print_help()
         sys.exit(1)
+    if args.command == 'serve':
+        return args
+    if args.command == 'search':
+        if args.query is None and not args.batch:
+            # a single positional argument is the query
+            args.query, args.path_to_code = args.path_to_code, None
+        args.path_to_code = args.path_to_code or os.getcwd()
     # Ensure path_to_code is a valid directory
     args.path_to_code = os.path.abspath(args.path_to_code)
     if not os.path.isdir(args.path_to_code):
@@ -104,7 +186,13 @@ def parse_arguments():
             for language in args.languages:
                 validate_language(language)
     else:
-        if args.command == 'search' and not args.query:
+        if args.command == 'search' and args.batch and args.query:
+            print("Error: Give either a query or --batch, not both.")
+            sys.exit(1)
+        if args.command == 'search' and args.batch and args.collections:
+            print("Error: --collections can't be combined with --batch.")
+            sys.exit(1)
+        if args.command == 'search' and not args.batch and not args.query:
             print(f"Error: The search query cannot be empty.")
             sys.exit(1)
 
@@ -113,108 +201,403 @@ def parse_arguments():
 
 def debug_index(args):
     print(f"Listing indexed files for collection: {args.collection}")
-    for file_doc in db.hashes_cursor():
+    for file_doc in db.known_files(args.resync).values():
         relative_path = relativize(file_doc['path'], args.path_to_code)
         print(f"{relative_path}: {file_doc['hash']}")
 
 
-def index(args):
-    known_files_by_path = {}
-    for file_doc in tqdm(db.hashes_cursor(), desc="Loading known files from Astra", bar_format='{desc}: {n_fmt}'):
-        known_files_by_path[file_doc['path']] = file_doc
+def index(args, paths=None):
+    """
+    Index the new and changed files under args.path_to_code, or only those among `paths`
+    if given.  Returns the number of files that were (re-)indexed.
+    """
+    from tqdm import tqdm
+    known_files_by_path = db.known_files(args.resync)
+    db.ensure_lexical(lambda file_docs: tqdm(file_docs, desc="Building lexical index", unit="file"))
     n_unchanged = 0
-
-    all_paths = get_indexable_files(args.path_to_code, args.languages)
-    
-    # Prune list to changed or new files
-    paths_to_index = []
-    for full_path in all_paths:
-        file_doc = known_files_by_path.get(full_path)
-        if file_doc:
-            if hexdigest(full_path) == file_doc['hash']:
+    n_changed = 0
+    hashes_and_stats = {}
+
+    def changed_paths():
+        """
+        Yield new or changed files as the walk finds them, so indexing starts before the walk ends.
+        Files whose size and mtime match the manifest are skipped without reading them; the
+        others are checked for binary content and hashed once, here.
+        """
+        nonlocal n_unchanged, n_changed
+        if paths is None:
+            # binary files are sniffed below, once the manifest says they're new or changed
+            candidates = get_indexable_files(args.path_to_code, args.languages, max_file_bytes=args.max_file_size,
+                                             skip_binary=False, workers=args.walk_workers)
+        else:
+            candidates = paths
+        for full_path in candidates:
+            file_doc = known_files_by_path.get(full_path)
+            try:
+                stat = os.stat(full_path)
+                if file_doc and manifest.unchanged(file_doc, stat):
+                    n_unchanged += 1
+                    continue
+                if is_binary(full_path):
+                    continue
+                file_hash = hexdigest(full_path)
+            except FileNotFoundError:
+                # deleted or renamed away since it was listed or its watch event was reported
+                if file_doc:
+                    db.delete(file_doc['_id'])
+                continue
+            if file_doc and file_hash == file_doc['hash']:
+                db.touch(file_doc, stat)
                 n_unchanged += 1
                 continue
-            else:
-                db.delete(file_doc['_id'])
-        paths_to_index.append(full_path)
+            hashes_and_stats[full_path] = (file_hash, stat)
+            n_changed += 1
+            pbar.total = n_changed
+            pbar.refresh()
+            yield full_path
 
-    if not paths_to_index:
-        print('No new or changed files to index')
-        return
-    # encode and store the interesting files
-    if n_unchanged:
-        print(f'{n_unchanged} files unchanged')
-    with tqdm(paths_to_index, 
-              bar_format='{desc} {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]',
-              unit="file") as pbar:
-        for full_path in pbar:
-            file_doc = known_files_by_path.get(full_path)
-            file_id = file_doc['_id'] if file_doc else None
+    from chunking import chunkify_file, chunkify_files
 
-            from encoder import encode
-            contents = open(full_path, 'r', encoding='utf-8').read()
-            language = infer_language(full_path)
-            chunks = chunkify_code(contents, language)
-            encoded_chunks = encode(chunks)
-            db.insert(file_id, full_path, chunks, encoded_chunks)
-            
+    def diff_chunks(item):
+        full_path, chunks = item
+        file_doc = known_files_by_path.get(full_path)
+        if not file_doc:
+            return full_path, chunks, None
+        # keep the chunks that are already stored, and only embed and insert the new ones
+        stored = db.get_chunk_hashes(file_doc['_id'])
+        new_chunks = []
+        for chunk in chunks:
+            ids = stored.get(text_hash(chunk))
+            if ids:
+                ids.pop()
+            else:
+                new_chunks.append(chunk)
+        removed = {chunk_hash: ids for chunk_hash, ids in stored.items() if ids}
+        return full_path, new_chunks, removed
+
+    def encode_chunks(item):
+        # doesn't wait for the embeddings, so chunks keep arriving to fill the batcher's requests
+        full_path, chunks, removed = item
+        return full_path, chunks, batcher.submit(chunks), removed
+
+    def store_chunks(item):
+        full_path, chunks, embedded, removed = item
+        with metrics.span('embed.wait'):
+            encoded_chunks = embedded.result()
+        file_doc = known_files_by_path.get(full_path)
+        file_hash, stat = hashes_and_stats[full_path]
+        if file_doc:
+            db.update(file_doc['_id'], full_path, chunks, encoded_chunks, removed, file_hash, stat)
+        else:
+            db.insert(None, full_path, chunks, encoded_chunks, file_hash, stat)
+        return full_path
+
+    if args.chunk_processes:
+        # files are parsed in worker processes; the threads only diff against the database
+        items = chunkify_files(changed_paths(), args.chunk_processes)
+        first_stage = pipeline.Stage('diff', diff_chunks, args.chunk_workers)
+    else:
+        items = changed_paths()
+        first_stage = pipeline.Stage('chunk', lambda full_path: diff_chunks(chunkify_file(full_path)), args.chunk_workers)
+    from encoder import MAX_BATCH_INPUTS, Batcher
+    # files wait for their embeddings in the queue in front of the insert stage, which holds
+    # enough of them to keep embed_workers full requests in flight even with one chunk per file
+    stages = [first_stage,
+              pipeline.Stage('embed', encode_chunks),
+              pipeline.Stage('insert', store_chunks, args.insert_workers,
+                             queue_size=args.embed_workers * MAX_BATCH_INPUTS)]
+    # the total grows as the walk finds changed files; the bar isn't shown if there are none
+    with Batcher(max_inflight=args.embed_workers) as batcher, \
+            tqdm(total=0, delay=0.5,
+                 bar_format='{desc} {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]',
+                 unit="file") as pbar:
+        for full_path in pipeline.run(items, stages):
             # Update the description with the current filename, fixed to 40 characters
             filename = os.path.basename(full_path)
             desc = f"Indexing {filename[:37]}..." if len(filename) > 37 else f"Indexing {filename:<40}"
             pbar.set_description(desc)
+            pbar.update(1)
+
+    # watch mode reports on its own
+    if paths is None:
+        if not n_changed:
+            print('No new or changed files to index')
+        elif n_unchanged:
+            print(f'{n_unchanged} files unchanged')
+    return n_changed
+
+
+def watch(args):
+    """
+    Keep the index up to date until interrupted: re-index files as they are created or
+    modified, and remove them from the index when they are deleted or renamed away.
+    """
+    from watch import changes, open_watcher
+    # index() sniffs new and changed files for binary content itself
+    indexable = IndexableFilter(args.path_to_code, args.languages, args.max_file_size, skip_binary=False)
+    root = indexable.root
+
+    def list_files():
+        return get_indexable_files(root, args.languages, max_file_bytes=args.max_file_size, skip_binary=False,
+                                   workers=args.walk_workers)
+
+    watcher = open_watcher(indexable, list_files)
+    args.resync = False
+    print(f'Watching {root} for changes (Ctrl-C to stop)', flush=True)
+    try:
+        for paths in changes(watcher):
+            known = db.known_files()
+            if paths is None or any(os.path.basename(path) in IGNORE_FILES for path in paths):
+                # events were lost, or the ignore rules changed: check every file
+                indexable.reset()
+                paths = set(list_files()) | {path for path in known if path.startswith(root + os.sep)}
+            # a path that is no longer a file may have been a directory holding indexed files
+            directories = tuple(path + os.sep for path in paths if not os.path.isfile(path))
+            removed = [file_doc for path, file_doc in known.items()
+                       if (path in paths or path.startswith(directories)) and not indexable.file(path)]
+            db.delete_many(file_doc['_id'] for file_doc in removed)
+            n_indexed = index(args, [path for path in paths if indexable.file(path)])
+            if n_indexed or removed:
+                print(f"{time.strftime('%H:%M:%S')} indexed {n_indexed} files, removed {len(removed)}", flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
 
 
 from collections import defaultdict
 
+def merge_results(mode, vector_results, lexical_results, limit):
+    """Return the results for the search mode; hybrid fuses the vector and lexical rankings."""
+    if mode == 'lexical':
+        return lexical_results
+    if mode == 'vector':
+        return vector_results
+    return fuse([vector_results, lexical_results], limit)
+
+
+def open_lexical(collection):
+    """Return the collection's lexical index, or exit with an error if it hasn't been built."""
+    lexical = db.open_lexical(collection)
+    if not lexical.built:
+        print(f"Error: Collection {collection} has no lexical index; run `ase index` to build it, "
+              "or search with --mode vector.")
+        sys.exit(1)
+    return lexical
+
+
 def search(args):
-    from encoder import encode
-    encoded_query = encode([args.query])[0]
-    results = db.search(encoded_query, args.max_count)
-    
+    if args.batch:
+        return search_batch(args)
+    if args.collections:
+        return search_collections(args)
+    nprobe = 0 if args.exact else args.nprobe
+    # hybrid search fuses deeper candidate lists than it returns
+    n_candidates = args.max_count * 2 if args.mode == 'hybrid' else args.max_count
+    lexical_results = vector_results = None
+    if args.mode in ('lexical', 'hybrid'):
+        # the lexical index is local, so this needs neither the embedding API nor the database
+        lexical_results = open_lexical(args.collection).search(args.query, n_candidates)
+    if args.mode in ('vector', 'hybrid'):
+        if not args.no_server:
+            vector_results = client.search(args.collection, args.query, n_candidates, nprobe)
+        if vector_results is None:
+            # no daemon running; do the work in-process
+            from encoder import encode
+            db.init(args.collection)
+            encoded_query = encode([args.query])[0]
+            vector_results = db.search(encoded_query, n_candidates, nprobe)
+    print_results(args, merge_results(args.mode, vector_results, lexical_results, args.max_count))
+
+
+def search_collections(args):
+    """
+    Search every collection named by args.collections for the query, which is embedded
+    only once, and merge the results into one top list, each labeled with its collection.
+    """
+    try:
+        collections = db.resolve_collections(args.collections)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    nprobe = 0 if args.exact else args.nprobe
+    n_candidates = args.max_count * 2 if args.mode == 'hybrid' else args.max_count
+    lexical_results = vector_results = None
+    if args.mode in ('lexical', 'hybrid'):
+        lexical_results = heapq.nlargest(n_candidates, (dict(result, collection=collection)
+                                                        for collection in collections
+                                                        for result in open_lexical(collection).search(args.query, n_candidates)),
+                                         key=lambda result: result['score'])
+    if args.mode in ('vector', 'hybrid'):
+        if not args.no_server:
+            vector_results = client.search_collections(collections, args.query, n_candidates, nprobe)
+        if vector_results is None:
+            from encoder import encode
+            vector_results = db.search_collections(collections, encode([args.query])[0], n_candidates, nprobe)
+    print_results(args, merge_results(args.mode, vector_results, lexical_results, args.max_count))
+
+
+def print_results(args, results):
+    """Print the results, or with -l only their files; results from --collections are prefixed with their collection."""
+    def label(result):
+        path = relativize(result['path'], args.path_to_code)
+        return f"[{result['collection']}] {path}" if 'collection' in result else path
+
     if args.files_with_matches:
-        # Group results by file_id
+        # Group results by file
         results_by_file = defaultdict(int)
         for result in results:
-            results_by_file[result['file_id']] += 1
+            results_by_file[label(result)] += 1
         
         # Sort files by match count in descending order
         sorted_files = sorted(results_by_file.items(), key=lambda x: x[1], reverse=True)
         
         # Print file paths
-        for file_id, count in sorted_files:
-            full_path = db.file_by_id(file_id)['path']
-            print(f"{relativize(full_path, args.path_to_code)}")
+        for labeled_path, count in sorted_files:
+            print(labeled_path)
     else:
         for result in results:
-            file_id = result['file_id']
-            full_path = db.file_by_id(file_id)['path']
-            print(f"# {relativize(full_path, args.path_to_code)} #")
+            print(f"# {label(result)} #")
             print(result['chunk'])
             print("\n" + "-" * 80 + "\n")  # Separator between chunks
 
 
+# queries per embedding request, and per round trip to `ase serve`, with `ase search --batch`
+BATCH_WINDOW = 100
+
+
+def read_queries(f):
+    """
+    Yield (id, query) for each non-empty line of f: either the query itself, or a JSON
+    object with 'query' and optionally 'id'.  The id defaults to the line number.
+    """
+    for n, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('{'):
+            record = json.loads(line)
+            yield record.get('id', n), record['query']
+        else:
+            yield n, line
+
+
+def search_batch(args):
+    """
+    Run many queries in one process: queries are embedded a window at a time (so one
+    embedding request covers many of them), their lookups run concurrently, and while
+    one window is being searched the next is being embedded.  Results are written to
+    stdout as JSON lines, in input order.
+    """
+    nprobe = 0 if args.exact else args.nprobe
+    n_candidates = args.max_count * 2 if args.mode == 'hybrid' else args.max_count
+    use_server = (args.mode != 'lexical' and not args.no_server
+                  and client.request({'command': 'ping'}) is not None)
+    if args.mode != 'lexical' and not use_server:
+        db.init(args.collection)
+    lexical = open_lexical(args.collection) if args.mode in ('lexical', 'hybrid') else None
+
+    def windows(f):
+        window = []
+        for query_id, query in read_queries(f):
+            window.append((query_id, query))
+            if len(window) == BATCH_WINDOW:
+                yield window
+                window = []
+        if window:
+            yield window
+
+    def embed(item):
+        n, window = item
+        if args.mode == 'lexical' or use_server:
+            return n, window, None
+        from encoder import encode
+        return n, window, encode([query for _, query in window])
+
+    def lookup(item):
+        n, window, embeddings = item
+        queries = [query for _, query in window]
+        vector_results = lexical_results = [None] * len(window)
+        if use_server:
+            vector_results = client.search_batch(args.collection, queries, n_candidates, nprobe)
+        elif embeddings is not None:
+            vector_results = list(executor.map(lambda embedding: db.search(embedding, n_candidates, nprobe),
+                                               embeddings))
+        if lexical:
+            lexical_results = list(executor.map(lambda query: lexical.search(query, n_candidates), queries))
+        return n, window, [merge_results(args.mode, vector, lexical_hits, args.max_count)
+                           for vector, lexical_hits in zip(vector_results, lexical_results)]
+
+    stages = [pipeline.Stage('embed', embed, 2), pipeline.Stage('search', lookup, 2)]
+    f = sys.stdin if args.batch == '-' else open(args.batch, 'r', encoding='utf-8')
+    pending = {}
+    next_window = 0
+    with f, ThreadPoolExecutor(args.search_workers) as executor:
+        for n, window, results in pipeline.run(enumerate(windows(f)), stages, queue_size=4):
+            pending[n] = (window, results)
+            # the pipeline finishes windows out of order; write them in input order
+            while next_window in pending:
+                window, results = pending.pop(next_window)
+                for (query_id, query), hits in zip(window, results):
+                    print(json.dumps({'id': query_id, 'query': query, 'results': [
+                        {'path': relativize(hit['path'], args.path_to_code), 'chunk': hit['chunk'],
+                         'score': hit.get('score', hit.get('$similarity'))} for hit in hits]}))
+                sys.stdout.flush()
+                next_window += 1
+
+
+def evaluate(args):
+    from quantize import QUANTIZATIONS
+    configs = [(dims, quantization) for dims in args.dims for quantization in args.quantization or QUANTIZATIONS]
+    try:
+        results = db.evaluate(args.queries, args.limit, configs, args.rows)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    # with ASE_RERANK=1 the full-precision vectors are stored as well as the codes
+    print(f"{'config':<16} {'bytes/vector':>12} {'smaller':>8} {f'recall@{args.limit}':>10} "
+          f"{'rerank bytes':>12} {'reranked':>9}")
+    for result in results:
+        print(f"{result['config']:<16} {result['bytes']:>12} {result['compression']:>7.1f}x "
+              f"{result['recall']:>10.3f} {result['reranked_bytes']:>12} {result['reranked_recall']:>9.3f}")
+
+
+def serve(args):
+    from server import serve
+    serve(args.socket)
+
+
+def find_file(full_path):
+    """Return the file document for the given path, or None if it isn't indexed."""
+    return find_files([full_path]).get(full_path)
+
+
+def find_files(full_paths):
+    """Return a dict of path -> file document for those of the paths that are indexed."""
+    known = db.known_files()
+    if any(full_path not in known for full_path in full_paths):
+        # the manifest may be behind changes made from another machine; resync it once for all of them
+        known = db.known_files(resync=True)
+    return {full_path: known[full_path] for full_path in full_paths if full_path in known}
+
+
 def prune(args):
-    # Create a dictionary mapping file paths to their document IDs
-    file_docs = {}
-    for doc in tqdm(db.hashes_cursor(), desc="Loading known files from Astra", bar_format='{desc}: {n_fmt}'):
-        file_docs[doc['path']] = doc['_id']
-    
+    found = {}
+    file_docs = find_files([os.path.abspath(file_path) for file_path in args.files])
     for file_path in args.files:
-        full_path = os.path.abspath(file_path)
-        if full_path in file_docs:
-            db.delete(file_docs[full_path])
-            print(f"Deleted {file_path} from the index.")
+        file_doc = file_docs.get(os.path.abspath(file_path))
+        if file_doc:
+            found[file_path] = file_doc
         else:
             print(f"File {file_path} not found in the index.")
+    db.delete_many(file_doc['_id'] for file_doc in found.values())
+    for file_path in found:
+        print(f"Deleted {file_path} from the index.")
 
 
 def debug_chunks(args):
     full_path = os.path.abspath(os.path.join(args.path_to_code, args.file))
-    file_doc = None
-    for doc in db.hashes_cursor():
-        if doc['path'] == full_path:
-            file_doc = doc
-            break
+    file_doc = find_file(full_path)
     
     if file_doc is None:
         print(f"File {args.file} not found in the index.")
@@ -234,17 +617,39 @@ def debug_chunks(args):
         print(chunk['chunk'])
 
 
-if __name__ == '__main__':
-    args = parse_arguments()
-    db.init(args.collection)
-    if args.command == 'index':
-        index(args)
-    elif args.command == 'search':
+def run(args):
+    # search and serve open the database themselves, if they need it
+    if args.command == 'search':
         search(args)
-    elif args.command == 'prune':
-        prune(args)
-    elif args.command == 'debug-chunks':
-        debug_chunks(args)
+    elif args.command == 'serve':
+        serve(args)
     else:
-        assert args.command == 'debug-index'
-        debug_index(args)
+        db.init(args.collection)
+        if args.command == 'index':
+            index(args)
+            if args.watch:
+                watch(args)
+        elif args.command == 'prune':
+            prune(args)
+        elif args.command == 'debug-chunks':
+            debug_chunks(args)
+        elif args.command == 'eval':
+            evaluate(args)
+        else:
+            assert args.command == 'debug-index'
+            debug_index(args)
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    profiling = getattr(args, 'profile', False) or getattr(args, 'metrics', None)
+    if profiling:
+        metrics.enable(trace=bool(args.metrics))
+    try:
+        run(args)
+    finally:
+        if profiling:
+            metrics.print_summary()
+            if args.metrics:
+                metrics.write(args.metrics)
+                print(f"Wrote metrics and trace to {args.metrics}", file=sys.stderr)
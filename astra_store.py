@@ -0,0 +1,231 @@
+import json
+import os
+import uuid
+
+from astrapy import DataAPIClient
+from astrapy.constants import VectorMetric
+from astrapy.exceptions import CollectionInsertManyException
+from astrapy.info import CollectionDefinition
+
+from bulk import BulkWriter
+from store import Store
+from util import ase_home, text_hash
+
+# Writes from concurrent callers are packed into insert_many requests of up to this many
+# bytes (estimated from the JSON sizes of the documents), and at most 100 documents, the
+# Data API's limit; deletes of many ids are packed into `$in` filters of up to 100 ids.
+# Each collection object keeps one pooled HTTP client, so the requests in flight reuse
+# its connections.
+WRITE_BATCH_BYTES = int(os.environ.get('ASE_ASTRA_BATCH_BYTES', 512 * 1024))
+WRITE_CONCURRENCY = int(os.environ.get('ASE_ASTRA_WRITE_CONCURRENCY', 8))
+MAX_BATCH_DOCUMENTS = 100
+MAX_IN_IDS = 100
+
+
+def _collections_cache_path():
+    return os.path.join(ase_home(), 'astra-collections.json')
+
+
+def _cached_collections(database_id):
+    """Return the names of the collections known to exist in the database, from the local cache."""
+    return set(_load_json(_collections_cache_path()).get(database_id, []))
+
+
+def _document_size(doc):
+    # a vector component takes about 20 characters of JSON
+    return len(doc.get('chunk', '')) + len(doc.get('path', '')) + 20 * len(doc.get('$vector', ())) + 100
+
+
+def _insert_flush(collection):
+    """
+    Return a BulkWriter flush that inserts documents with client-side ids, so retrying one
+    is idempotent: a retry first skips the documents that a failed request wrote anyway.
+    """
+    def flush(docs, retrying):
+        if retrying:
+            existing = {doc['_id'] for doc in collection.find({'_id': {'$in': [doc['_id'] for doc in docs]}},
+                                                               projection={'_id': 1})}
+            docs = [doc for doc in docs if doc['_id'] not in existing]
+        try:
+            collection.insert_many(docs, ordered=False, chunk_size=len(docs) or 1)
+        except CollectionInsertManyException as e:
+            inserted = set(e.inserted_ids)
+            return [doc for doc in docs if doc['_id'] not in inserted]
+        return []
+    return flush
+
+
+def _database():
+    """
+    Return the id of the database selected by ASTRA_DB_ID, and a handle to it.  The client
+    addresses databases by API endpoint: ASTRA_DB_API_ENDPOINT if set, or else the endpoint
+    looked up from the id, which is cached under ASE_HOME.
+    """
+    client = DataAPIClient(token=os.environ["ASTRA_DB_TOKEN"])
+    database_id = os.environ["ASTRA_DB_ID"]
+    api_endpoint = os.environ.get("ASTRA_DB_API_ENDPOINT") or _api_endpoint(client, database_id)
+    return database_id, client.get_database(api_endpoint)
+
+
+def _api_endpoint(client, database_id):
+    path = os.path.join(ase_home(), 'astra-endpoints.json')
+    endpoints = _load_json(path)
+    if database_id not in endpoints:
+        endpoints[database_id] = client.get_admin().database_info(database_id).regions[0].api_endpoint
+        _save_json(path, endpoints)
+    return endpoints[database_id]
+
+
+def list_collections():
+    """Return the names of the ase collections in the database, refreshing the cache of its collections."""
+    database_id, db = _database()
+    names = set(db.list_collection_names())
+    _cache_collections(database_id, names)
+    suffix = '_embeddings'
+    return sorted(name[:-len(suffix)] for name in names
+                  if name.endswith(suffix) and name[:-len(suffix)] + '_files' in names)
+
+
+def _cache_collections(database_id, names):
+    path = _collections_cache_path()
+    cached = _load_json(path)
+    cached[database_id] = sorted(names)
+    _save_json(path, cached)
+
+
+def _load_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_json(path, data):
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+class AstraStore(Store):
+    """Stores files and embeddings in a pair of Astra DB collections."""
+
+    def __init__(self, collection_name):
+        """
+        Create the embeddings and files collections if they don't exist.  Collections seen
+        to exist are cached under ASE_HOME, so later runs skip listing them.
+        """
+        print('Connecting to database for collection ' + collection_name)
+        database_id, db = _database()
+
+        embeddings_collection_name = collection_name + "_embeddings"
+        files_collection_name = collection_name + "_files"
+
+        collections = _cached_collections(database_id)
+        if {embeddings_collection_name, files_collection_name} <= collections:
+            self._embeddings = db[embeddings_collection_name]
+            self._files = db[files_collection_name]
+        else:
+            self._create_collections(db, database_id, embeddings_collection_name, files_collection_name)
+        self._start_writers()
+
+    def _create_collections(self, db, database_id, embeddings_collection_name, files_collection_name):
+        collections = set(c.name for c in db.list_collections())
+
+        if embeddings_collection_name in collections:
+            self._embeddings = db[embeddings_collection_name]
+        else:
+            definition = (CollectionDefinition()
+                          .with_vector_dimension(768)
+                          .with_vector_metric(VectorMetric.COSINE)
+                          .with_indexing('deny', ['chunk']))
+            self._embeddings = db.create_collection(embeddings_collection_name, definition=definition)
+
+        if files_collection_name in collections:
+            self._files = db[files_collection_name]
+        else:
+            self._files = db.create_collection(files_collection_name)
+        _cache_collections(database_id, collections | {embeddings_collection_name, files_collection_name})
+
+    def _start_writers(self):
+        """
+        Writes go through bulk writers that pack the documents and ids of concurrent
+        callers (the index pipeline's insert threads) into shared requests.
+        """
+        def delete_files(file_ids, retrying):
+            # the chunks first, so a failure never leaves chunks whose file is gone
+            self._embeddings.delete_many({'file_id': {'$in': file_ids}})
+            self._files.delete_many({'_id': {'$in': file_ids}})
+            return []
+
+        def delete_chunks(chunk_ids, retrying):
+            self._embeddings.delete_many({'_id': {'$in': chunk_ids}})
+            return []
+
+        self._chunk_writer = BulkWriter('astra.insert_chunks', _insert_flush(self._embeddings), MAX_BATCH_DOCUMENTS,
+                                        WRITE_BATCH_BYTES, _document_size, WRITE_CONCURRENCY)
+        self._file_writer = BulkWriter('astra.insert_files', _insert_flush(self._files), MAX_BATCH_DOCUMENTS,
+                                       WRITE_BATCH_BYTES, _document_size, WRITE_CONCURRENCY)
+        self._file_deleter = BulkWriter('astra.delete_files', delete_files, MAX_IN_IDS,
+                                        max_inflight=WRITE_CONCURRENCY)
+        self._chunk_deleter = BulkWriter('astra.delete_chunks', delete_chunks, MAX_IN_IDS,
+                                         max_inflight=WRITE_CONCURRENCY)
+
+    def hashes_cursor(self):
+        return self._files.find({})
+
+    def file_by_id(self, file_id):
+        return self._files.find_one({'_id': file_id})
+
+    def files_by_ids(self, file_ids):
+        return list(self._files.find({'_id': {'$in': list(file_ids)}}))
+
+    def delete(self, file_id):
+        self._file_deleter.write([file_id])
+
+    def delete_many(self, file_ids):
+        self._file_deleter.write(list(file_ids))
+
+    def insert(self, file_id, full_path, file_hash, chunks, encoded_chunks):
+        file_id = file_id or str(uuid.uuid4())
+        written = [self._file_writer.submit([{"_id": file_id, "path": full_path, "hash": file_hash}]),
+                   self._submit_chunks(file_id, full_path, chunks, encoded_chunks)]
+        for future in written:
+            future.result()
+        return file_id
+
+    def _submit_chunks(self, file_id, full_path, chunks, encoded_chunks):
+        # the path is denormalized onto each chunk so search results don't need a files lookup
+        embeddings_docs = [{'_id': str(uuid.uuid4()), 'file_id': file_id, 'path': full_path, 'chunk': chunk,
+                            'chunk_hash': text_hash(chunk), '$vector': embedding}
+                           for chunk, embedding in zip(chunks, encoded_chunks)]
+        return self._chunk_writer.submit(embeddings_docs)
+
+    def update(self, file_id, full_path, file_hash, chunks, encoded_chunks, removed_chunk_ids):
+        written = [self._chunk_deleter.submit(list(removed_chunk_ids)),
+                   self._submit_chunks(file_id, full_path, chunks, encoded_chunks)]
+        for future in written:
+            future.result()
+        # the new hash only once the chunks match it
+        self._files.update_one({"_id": file_id}, {"$set": {"hash": file_hash}})
+
+    def get_chunk_hashes(self, file_id):
+        hashes = {}
+        for doc in self._embeddings.find({"file_id": file_id}, projection={"chunk_hash": 1, "chunk": 1}):
+            # chunks indexed before chunk hashes were stored are hashed on the fly
+            chunk_hash = doc.get('chunk_hash') or text_hash(doc['chunk'])
+            hashes.setdefault(chunk_hash, []).append(doc['_id'])
+        return hashes
+
+    def search(self, query_embedding, limit, nprobe=None):
+        return self._embeddings.find(
+            {},
+            sort={"$vector": query_embedding},
+            limit=limit,
+            include_similarity=True,
+            projection={"file_id": 1, "path": 1, "chunk": 1}
+        )
+
+    def get_chunks_by_file_id(self, file_id):
+        return list(self._embeddings.find({"file_id": file_id}, projection={"chunk": 1, "_id": 0}))
@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class Submission:
+    """The items of one `submit` call; its future resolves once all of them are done."""
+
+    def __init__(self, n):
+        self.remaining = n
+        self.future = Future()
+        self._lock = threading.Lock()
+
+    def result(self):
+        """The value the future resolves to."""
+        return None
+
+    def resolve(self, n):
+        with self._lock:
+            self.remaining -= n
+            done = self.remaining == 0 and not self.future.done()
+        if done:
+            self.future.set_result(self.result())
+
+    def fail(self, e):
+        with self._lock:
+            if self.future.done():
+                return
+            self.future.set_exception(e)
+
+
+class Dispatcher:
+    """
+    Packs the items submitted by many callers into as few requests as possible.
+
+    Items are queued with `_enqueue` and packed together with those of concurrent callers
+    into batches of up to `max_items` items and `max_size` in total (as estimated by
+    `size`), and `_send(batch)` is called on each batch, a list of (submission, item, size),
+    with at most `max_inflight` batches outstanding.  A partially filled batch is sent once
+    no new items have arrived for `linger` seconds.  `_send` resolves the submissions; if it
+    raises, all of them fail.
+    """
+
+    def __init__(self, name, max_items, max_size=None, size=len, max_inflight=4, linger=0.05):
+        self.name = name
+        self.linger = linger
+        self._max_items = max_items
+        self._max_size = max_size
+        self._size = size
+        self._pending = deque()  # (submission, item, size) not yet sent
+        self._pending_size = 0
+        self._last_submit = 0.0
+        self._cond = threading.Condition()
+        self._slots = threading.Semaphore(max_inflight)
+        self._executor = ThreadPoolExecutor(max_workers=max_inflight, thread_name_prefix=name)
+        self._closed = False
+        self._dispatcher = threading.Thread(target=self._dispatch, name=f'{name}-batcher', daemon=True)
+        self._dispatcher.start()
+
+    def _enqueue(self, submission, items):
+        sized = [(submission, item, self._size(item) if self._max_size is not None else 0) for item in items]
+        with self._cond:
+            self._pending.extend(sized)
+            self._pending_size += sum(size for _, _, size in sized)
+            self._last_submit = time.monotonic()
+            self._cond.notify()
+
+    def _send(self, batch):
+        raise NotImplementedError
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._dispatcher.join()
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _full(self):
+        return (len(self._pending) >= self._max_items
+                or (self._max_size is not None and self._pending_size >= self._max_size))
+
+    def _take_batch(self):
+        batch, total = [], 0
+        while self._pending and len(batch) < self._max_items:
+            size = self._pending[0][2]
+            if batch and self._max_size is not None and total + size > self._max_size:
+                break
+            batch.append(self._pending.popleft())
+            total += size
+        self._pending_size -= total
+        return batch
+
+    def _dispatch(self):
+        while True:
+            # wait for a free request slot first, so items keep accumulating into fuller batches
+            self._slots.acquire()
+            with self._cond:
+                while True:
+                    if self._pending and (self._full() or self._closed
+                                          or time.monotonic() - self._last_submit >= self.linger):
+                        break
+                    if self._closed:
+                        self._slots.release()
+                        return
+                    self._cond.wait(self.linger if self._pending else None)
+                batch = self._take_batch()
+            self._executor.submit(self._run, batch)
+
+    def _run(self, batch):
+        try:
+            self._send(batch)
+        except BaseException as e:
+            for submission in set(submission for submission, _, _ in batch):
+                submission.fail(e)
+        finally:
+            self._slots.release()
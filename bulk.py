@@ -0,0 +1,62 @@
+import random
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+import metrics
+from batching import Dispatcher, Submission
+
+MAX_RETRIES = 4
+MAX_BACKOFF = 10.0
+
+
+class BulkWriter(Dispatcher):
+    """
+    Packs the writes of many callers into as few requests as possible, like encoder.Batcher
+    does for embeddings.
+
+    Callers call `write(items)`, which blocks until every item has been written.  Items are
+    packed together with those of concurrent callers into batches of up to `max_items`
+    items and `max_bytes` bytes (as estimated by `size`), and `flush(batch, retrying)` is
+    called on each batch with at most `max_inflight` batches outstanding.  A partially
+    filled batch is sent once no new items have arrived for `linger` seconds.
+
+    `flush` returns the items it failed to write, or raises; either way they are retried
+    with backoff, with retrying=True, up to MAX_RETRIES times.  Since an item may have been
+    written by a request that failed anyway, flush must be idempotent.
+    """
+
+    def __init__(self, name, flush, max_items, max_bytes=None, size=len, max_inflight=8, linger=0.02):
+        super().__init__(name, max_items, max_bytes, size, max_inflight, linger)
+        self._flush = flush
+
+    def submit(self, items) -> Future:
+        """Queue `items` for writing; the returned future resolves once they are all written."""
+        submission = Submission(len(items))
+        if not items:
+            submission.future.set_result(None)
+            return submission.future
+        self._enqueue(submission, items)
+        return submission.future
+
+    def write(self, items):
+        self.submit(items).result()
+
+    def _send(self, batch):
+        items = [item for _, item, _ in batch]
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                with metrics.span(f'bulk.{self.name}', nbytes=sum(size for _, _, size in batch)):
+                    failed = self._flush(items, attempt > 0)
+                error = None
+            except Exception as e:
+                failed, error = items, e
+            if not failed or attempt == MAX_RETRIES:
+                break
+            metrics.record(f'bulk.{self.name}.retries')
+            items = failed
+            time.sleep(min(MAX_BACKOFF, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5))
+        if failed:
+            raise error or RuntimeError(f'{len(failed)} {self.name} writes failed after {MAX_RETRIES} retries')
+        for submission, n in Counter(submission for submission, _, _ in batch).items():
+            submission.resolve(n)
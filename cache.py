@@ -0,0 +1,77 @@
+import os
+import sqlite3
+import threading
+import time
+
+from util import ase_home
+
+
+class DiskCache:
+    """
+    A persistent key/value cache stored in SQLite under ASE_HOME.
+    Values are bytes.  When the total size of the stored values exceeds max_bytes,
+    the least recently used entries are evicted.
+    """
+
+    def __init__(self, name, max_bytes):
+        self.path = os.path.join(ase_home(), f'{name}.sqlite')
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                           '(key TEXT PRIMARY KEY, value BLOB NOT NULL, used REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+        self._conn.commit()
+        self._size = self._conn.execute('SELECT COALESCE(SUM(LENGTH(value)), 0) FROM entries').fetchone()[0]
+
+    def get_many(self, keys) -> dict:
+        """Return a dict of key -> value for the keys that are present in the cache."""
+        keys = list(set(keys))
+        found = {}
+        with self._lock:
+            # stay well under SQLite's limit on bound parameters
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                placeholders = ','.join('?' * len(batch))
+                rows = self._conn.execute(f'SELECT key, value FROM entries WHERE key IN ({placeholders})', batch)
+                found.update(rows)
+            if found:
+                hits = list(found)
+                now = time.time()
+                for i in range(0, len(hits), 500):
+                    batch = hits[i:i + 500]
+                    placeholders = ','.join('?' * len(batch))
+                    self._conn.execute(f'UPDATE entries SET used = ? WHERE key IN ({placeholders})', [now] + batch)
+                self._conn.commit()
+        return found
+
+    def put_many(self, items: dict):
+        """Store the given key -> value pairs, evicting old entries if the cache is over budget."""
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO entries (key, value, used) VALUES (?, ?, ?)',
+                                   [(key, value, now) for key, value in items.items()])
+            self._size += sum(len(value) for value in items.values())
+            if self._size > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # recompute since other processes may share the cache file
+        self._size = self._conn.execute('SELECT COALESCE(SUM(LENGTH(value)), 0) FROM entries').fetchone()[0]
+        # evict down to 90% of the budget so we don't evict on every insert
+        target = self.max_bytes * 0.9
+        while self._size > target:
+            rows = self._conn.execute('SELECT key, LENGTH(value) FROM entries ORDER BY used LIMIT 1000').fetchall()
+            if not rows:
+                break
+            evicted = []
+            for key, size in rows:
+                if self._size <= target:
+                    break
+                evicted.append((key,))
+                self._size -= size
+            self._conn.executemany('DELETE FROM entries WHERE key = ?', evicted)
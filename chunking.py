@@ -1,23 +1,53 @@
 import warnings
 import os
-import sys
-from anthropic import Anthropic
+import re
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 warnings.simplefilter("ignore", category=FutureWarning)
-from tree_sitter_languages import get_parser
-from util import infer_language
-from pyrate_limiter import Duration, Rate, Limiter
+import metrics
+from cache import DiskCache
+from ratelimit import RateLimiter
+from util import estimate_tokens, get_indexable_files, infer_language, text_hash
 
-# Initialize the Anthropic client
-client = Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+# The Anthropic client is created on first use: importing the SDK alone takes over a second,
+# which commands that never generate contexts (and chunking worker processes) shouldn't pay
+_client = None
 
-# Initialize the rate limiter
-limiter = Limiter(Rate(900, Duration.MINUTE))
+# Initialize the rate limiter: 900 requests per minute by default, optionally also limited by tokens
+limiter = RateLimiter('anthropic-context', int(os.environ.get('ASE_CONTEXT_RPM', 900)),
+                      int(os.environ.get('ASE_CONTEXT_TPM', 0)) or None)
+
+# Number of concurrent context requests, shared by all files being chunked
+CONTEXT_WORKERS = int(os.environ.get('ASE_CONTEXT_WORKERS', 8))
+_context_pool = None
+_context_cache = None
+_context_lock = threading.Lock()
+
+# Chunks are sized for the embedding model, in tokens as estimated by util.estimate_tokens:
+# definitions longer than CHUNK_MAX_TOKENS are split between their statements, each piece
+# repeating the signature and overlapping the piece before by up to CHUNK_OVERLAP_TOKENS;
+# runs of chunks smaller than CHUNK_MIN_TOKENS are merged up to CHUNK_TARGET_TOKENS.
+CHUNK_MAX_TOKENS = int(os.environ.get('ASE_CHUNK_MAX_TOKENS', 1500))
+CHUNK_MIN_TOKENS = int(os.environ.get('ASE_CHUNK_MIN_TOKENS', 64))
+CHUNK_TARGET_TOKENS = int(os.environ.get('ASE_CHUNK_TARGET_TOKENS', 400))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get('ASE_CHUNK_OVERLAP_TOKENS', 64))
+# about one small chunk in this many starts a new group of merged chunks (see _merge_small)
+MERGE_ANCHOR_EVERY = 8
+# estimate_tokens counts about 4 characters per token; sizes here are measured in UTF-8 bytes,
+# which only overestimates non-ASCII text
+BYTES_PER_TOKEN = 4
 
 def chunkify_code(code: str, language: str) -> list[str]:
     """
     Extracts chunks from the code and adds context to each chunk using Claude Haiku.
     """
-    return [contextify(raw_chunk, code) for raw_chunk in extract_chunks(code, language)]
+    raw_chunks = extract_sized_chunks(code, language)
+    if os.environ.get("ASE_CONTEXT") == "contextual":
+        contexts = get_chunk_contexts(code, raw_chunks)
+        return [context + '\n\n' + chunk for context, chunk in zip(contexts, raw_chunks)]
+    return [contextify(raw_chunk, code) for raw_chunk in raw_chunks]
 
 def contextify(chunk: str, full_code: str) -> str:
     if os.environ.get("ASE_CONTEXT") == "contextual":
@@ -27,15 +57,43 @@ def contextify(chunk: str, full_code: str) -> str:
         return extract_class_header(code) + '\n\n' + chunk
     return chunk
 
+_parsers = threading.local()
+
+
+def get_cached_parser(language: str):
+    """Return a parser for the language, reused across calls.  Parsers aren't thread-safe, so each thread gets its own."""
+    parsers = getattr(_parsers, 'by_language', None)
+    if parsers is None:
+        parsers = _parsers.by_language = {}
+    if language not in parsers:
+        from tree_sitter_languages import get_parser
+        parsers[language] = get_parser(language)
+    return parsers[language]
+
+
+def _parse(code: str, language: str):
+    parser = get_cached_parser(language)
+    code_bytes = code.encode('utf-8')
+    with metrics.span('chunk.parse', nbytes=len(code_bytes)):
+        tree = parser.parse(code_bytes)
+    return code_bytes, tree
+
+
 def extract_chunks(code: str, language: str) -> list[str]:
     """
     Splits code into semantically meaningful chunks using tree-sitter.
+    Runs in a single pass over the tree, in time linear in the size of the code.
     """
-    parser = get_parser(language)
-    code_bytes = code.encode('utf-8')
-    tree = parser.parse(code_bytes)
+    code_bytes, tree = _parse(code, language)
+    return [chunk for _, chunk, _ in _definitions(code_bytes, tree)]
 
-    chunks = []
+
+def _definitions(code_bytes, tree):
+    """
+    Return (node, text, ranges) for each definition in the tree, in source order, where
+    ranges are the (start, end) byte ranges that the text is made of.
+    """
+    definitions = []
 
     def is_definition(node):
         """Check if a node represents a definition rather than just a declaration."""
@@ -46,44 +104,321 @@ def extract_chunks(code: str, language: str) -> list[str]:
             return any(child.type == "block" for child in node.children)
         return False
 
-    def byte_to_char_offset(byte_offset):
-        return len(code_bytes[:byte_offset].decode('utf-8'))
+    def text(start_byte, end_byte):
+        # node boundaries always fall on character boundaries, so slicing the bytes and
+        # decoding just the slice is equivalent to converting the offsets to characters
+        return code_bytes[start_byte:end_byte].decode('utf-8')
 
-    def traverse(node):
+    # depth-first, in source order, with an explicit stack so deeply nested code can't
+    # exceed the recursion limit
+    stack = [tree.root_node]
+    while stack:
+        node = stack.pop()
         if node.type in ("class_declaration", "interface_declaration", "enum_declaration"):
             # For classes, interfaces, and enums, we'll include the full declaration line and fields
-            class_def_end = next((child.start_byte for child in node.children if child.type == "class_body"), node.end_byte)
-            full_def = code[byte_to_char_offset(node.start_byte):byte_to_char_offset(class_def_end)].strip()
-            class_fields = [full_def]
             class_body = next((child for child in node.children if child.type == "class_body"), None)
+            class_def_end = class_body.start_byte if class_body else node.end_byte
+            class_fields = [text(node.start_byte, class_def_end).strip()]
+            ranges = [(node.start_byte, class_def_end)]
             if class_body:
                 for child in class_body.children:
                     if child.type in ("field_declaration", "variable_declaration"):
-                        field_chunk = code[byte_to_char_offset(child.start_byte):byte_to_char_offset(child.end_byte)].strip()
-                        class_fields.append(field_chunk)
-            if class_fields:
-                chunks.append("\n".join(class_fields))
+                        class_fields.append(text(child.start_byte, child.end_byte).strip())
+                        ranges.append((child.start_byte, child.end_byte))
+            definitions.append((node, "\n".join(class_fields), ranges))
             # Continue traversing to handle nested classes and methods
-            for child in node.children:
-                traverse(child)
+            stack.extend(reversed(node.children))
         elif node.type in ("function_definition", "method_definition", "function_declaration", "method_declaration", "constructor_declaration"):
             if is_definition(node):
-                method_chunk = code[byte_to_char_offset(node.start_byte):byte_to_char_offset(node.end_byte)]
-                chunks.append(method_chunk)
+                definitions.append((node, text(node.start_byte, node.end_byte), [(node.start_byte, node.end_byte)]))
         else:
             # For other node types, continue traversing
-            for child in node.children:
-                traverse(child)
+            stack.extend(reversed(node.children))
+
+    return definitions
 
-    traverse(tree.root_node)
 
+def extract_sized_chunks(code: str, language: str) -> list[str]:
+    """
+    Like extract_chunks, but with the chunks sized for embedding (see CHUNK_MAX_TOKENS), and
+    with the code outside any definition (imports, module-level statements, class headers
+    in languages whose classes aren't chunks) in chunks of its own.  Definitions include
+    their decorators and the comments directly above them.
+    """
+    code_bytes, tree = _parse(code, language)
+    pieces = []  # (start byte, text)
+    covered = []
+    for node, text, ranges in _definitions(code_bytes, tree):
+        start = _leading_start(code_bytes, node)
+        covered.append((start, ranges[0][1]))
+        covered.extend(ranges[1:])
+        if len(ranges) == 1:
+            pieces.extend(_split(code_bytes, node, start, ranges[0][1], _signature(code_bytes, node)))
+        else:
+            # a class header and its fields, which aren't contiguous in the source
+            text_bytes = (code_bytes[start:node.start_byte].decode('utf-8') + text).encode('utf-8')
+            pieces.extend((start, text_bytes[piece_start:piece_end].decode('utf-8'))
+                          for piece_start, piece_end in _line_segments(text_bytes, 0, len(text_bytes),
+                                                                       CHUNK_MAX_TOKENS * BYTES_PER_TOKEN))
+    for start, end in _uncovered(covered, len(code_bytes)):
+        pieces.extend((piece_start, text.strip()) for piece_start, text in _split(code_bytes, tree.root_node, start, end)
+                      if _WORD.search(text))
+    # stable, so the pieces of one definition stay in order
+    pieces.sort(key=lambda piece: piece[0])
+    chunks = _merge_small([text for _, text in pieces])
+    metrics.record('chunk.pieces', n=len(pieces))
     return chunks
 
 
+# leftover code with none of these (closing braces, blank lines) isn't worth a chunk
+_WORD = re.compile(r'\w')
+
+
+def _leading_start(code_bytes, node):
+    """Where the node starts, including a decorated_definition wrapping it and the comments directly above it."""
+    if node.parent is not None and node.parent.type == 'decorated_definition':
+        node = node.parent
+    start = node.start_byte
+    sibling = node.prev_sibling
+    while sibling is not None and 'comment' in sibling.type:
+        between = code_bytes[sibling.end_byte:start]
+        line_start = code_bytes.rfind(b'\n', 0, sibling.start_byte) + 1
+        # a comment on its own line(s), with no blank line before what it documents
+        if between.strip() or between.count(b'\n') > 1 or code_bytes[line_start:sibling.start_byte].strip():
+            break
+        start = sibling.start_byte
+        sibling = sibling.prev_sibling
+    return start
+
+
+def _signature(code_bytes, node):
+    """The definition's header (up to its body, or its first line if that's long), to repeat at the top of each piece it's split into."""
+    body = node.child_by_field_name('body')
+    end = body.start_byte if body is not None else node.end_byte
+    if end - node.start_byte > CHUNK_MAX_TOKENS * BYTES_PER_TOKEN // 8:
+        end = code_bytes.find(b'\n', node.start_byte, end)
+        if end < 0:
+            return ''
+    return code_bytes[node.start_byte:end].decode('utf-8').rstrip() + '\n'
+
+
+def _uncovered(covered, length):
+    """The byte ranges of [0, length) outside all of the covered ranges."""
+    gaps = []
+    position = 0
+    for start, end in sorted(covered):
+        if start > position:
+            gaps.append((position, start))
+        position = max(position, end)
+    if position < length:
+        gaps.append((position, length))
+    return gaps
+
+
+def _split(code_bytes, node, start, end, header=''):
+    """
+    Return the (start byte, text) pieces of code_bytes[start:end], the extent of node or
+    part of it, each within CHUNK_MAX_TOKENS.  Pieces are cut between node's statements
+    (or, below them, between smaller and smaller nodes); each piece after the first starts
+    with `header` and repeats the last lines of the piece before.
+    """
+    max_bytes = CHUNK_MAX_TOKENS * BYTES_PER_TOKEN
+    if end - start <= max_bytes:
+        return [(start, code_bytes[start:end].decode('utf-8'))]
+    overlap = CHUNK_OVERLAP_TOKENS * BYTES_PER_TOKEN
+    budget = max(max_bytes // 2, max_bytes - len(header.encode('utf-8')) - overlap)
+    pieces = []
+    for piece_start, piece_end in _pack(_segments(code_bytes, node, start, end, budget), budget):
+        if not pieces:
+            pieces.append((piece_start, code_bytes[piece_start:piece_end].decode('utf-8')))
+            continue
+        # whole lines only, so the overlap never starts mid-line or mid-character
+        overlap_start = max(start, piece_start - overlap)
+        if overlap_start > 0 and code_bytes[overlap_start - 1] != ord('\n'):
+            newline = code_bytes.find(b'\n', overlap_start, piece_start)
+            overlap_start = newline + 1 if newline >= 0 else piece_start
+        pieces.append((piece_start, header + code_bytes[overlap_start:piece_end].decode('utf-8')))
+    return pieces
+
+
+def _segments(code_bytes, node, start, end, max_bytes):
+    """
+    Cut code_bytes[start:end] into contiguous ranges of at most max_bytes, at the ends of
+    node's children, so comments and whitespace stay with the code after them.  Children
+    too big for one range are cut the same way, and leaves by lines.
+    """
+    segments = []
+    # in source order, with an explicit stack (like _definitions) so deeply nested code
+    # can't exceed the recursion limit; entries with no node are finished ranges
+    stack = [(node, start, end)]
+    while stack:
+        node, start, end = stack.pop()
+        if node is None:
+            segments.append((start, end))
+            continue
+        parts = []
+        position = start
+        for child in node.children:
+            if child.start_byte >= end:
+                break
+            child_end = min(child.end_byte, end)
+            if child_end <= position:
+                continue
+            parts.append((child if child_end - position > max_bytes else None, position, child_end))
+            position = child_end
+        if position < end:
+            parts.extend((None, segment_start, segment_end)
+                         for segment_start, segment_end in _line_segments(code_bytes, position, end, max_bytes))
+        stack.extend(reversed(parts))
+    return segments
+
+
+def _line_segments(data, start, end, max_bytes):
+    """Cut data[start:end] into ranges of at most max_bytes at line breaks, or mid-line if a line is longer."""
+    segments = []
+    while end - start > max_bytes:
+        cut = data.rfind(b'\n', start, start + max_bytes) + 1
+        if cut <= start:
+            cut = start + max_bytes
+            # back up to the start of a UTF-8 character
+            while data[cut] & 0xC0 == 0x80:
+                cut -= 1
+        segments.append((start, cut))
+        start = cut
+    segments.append((start, end))
+    return segments
+
+
+def _pack(segments, max_bytes):
+    """Join runs of contiguous segments into ranges of at most max_bytes."""
+    packed = []
+    for start, end in segments:
+        if packed and end - packed[-1][0] <= max_bytes:
+            packed[-1] = (packed[-1][0], end)
+        else:
+            packed.append((start, end))
+    return packed
+
+
+def _merge_small(chunks):
+    """
+    Merge runs of chunks smaller than CHUNK_MIN_TOKENS into groups of up to CHUNK_TARGET_TOKENS.
+    A group also ends before each anchor, a small chunk picked by its content hash, so the
+    boundaries don't depend on what comes earlier in the file: an edit changes its own group,
+    and the one next to it if the edit makes or unmakes an anchor, but no others.
+    """
+    merged = []
+    group_tokens = None  # tokens in merged[-1] while it's a group that can grow
+    for chunk in chunks:
+        size = estimate_tokens(chunk)
+        if size >= CHUNK_MIN_TOKENS:
+            merged.append(chunk)
+            group_tokens = None
+        elif group_tokens is not None and not _is_anchor(chunk) and group_tokens + size <= CHUNK_TARGET_TOKENS:
+            merged[-1] += '\n\n' + chunk
+            group_tokens += size
+        else:
+            merged.append(chunk)
+            group_tokens = size
+    return merged
+
+
+def _is_anchor(chunk):
+    return int(text_hash(chunk)[:8], 16) % MERGE_ANCHOR_EVERY == 0
+
+
+def chunkify_file(full_path: str) -> tuple[str, list[str]]:
+    """Reads and chunks one file, returning (full_path, chunks)."""
+    with open(full_path, 'r', encoding='utf-8') as f:
+        code = f.read()
+    with metrics.span('chunk'):
+        chunks = chunkify_code(code, infer_language(full_path))
+    metrics.record('chunk.chunks', n=len(chunks))
+    return full_path, chunks
+
+
+def _init_worker():
+    # the workers draw from one context quota, kept in SQLite under ASE_HOME, rather than
+    # each sending the full ASE_CONTEXT_RPM
+    limiter.shared = True
+
+
+def chunkify_files(paths, workers=None):
+    """
+    Chunks many files in parallel worker processes (default: one per CPU), each with its
+    own parsers.  Yields (full_path, chunks) in the same order as `paths`, as soon as each
+    result is ready; at most a few files per worker are in flight at once.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        yield from map(chunkify_file, paths)
+        return
+    # spawn rather than fork: callers (like the ase index pipeline) have other threads running
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append(pool.submit(chunkify_file, path))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def get_client():
+    global _client
+    with _context_lock:
+        if _client is None:
+            from anthropic import Anthropic
+            _client = Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+    return _client
+
+
+def _get_context_pool_and_cache():
+    global _context_pool, _context_cache
+    with _context_lock:
+        if _context_pool is None:
+            _context_pool = ThreadPoolExecutor(CONTEXT_WORKERS, thread_name_prefix='context')
+        max_mb = int(os.environ.get('ASE_CONTEXT_CACHE_MB', 512))
+        if _context_cache is None and max_mb > 0:
+            _context_cache = DiskCache('contexts', max_mb * 1024 * 1024)
+    return _context_pool, _context_cache
+
+
+def get_chunk_contexts(full_code: str, chunks: list[str]) -> list[str]:
+    """
+    Returns the context for each of the chunks of one document.
+
+    Contexts are cached on disk by (document hash, chunk hash), so unchanged chunks of an
+    unchanged document never call the LLM again.  The first uncached chunk is sent alone so
+    that it writes the document to the prompt cache; the rest are then sent concurrently and
+    all read the cached document.
+    """
+    pool, cache = _get_context_pool_and_cache()
+    doc_hash = text_hash(full_code)
+    keys = [doc_hash + ':' + text_hash(chunk) for chunk in chunks]
+    found = {key: value.decode('utf-8') for key, value in cache.get_many(keys).items()} if cache else {}
+    metrics.record('context.cache_hits', n=len(found))
+    missing = {}
+    for key, chunk in zip(keys, chunks):
+        if key not in found:
+            missing.setdefault(key, chunk)
+
+    if missing:
+        missing_keys = list(missing)
+        generated = {missing_keys[0]: get_chunk_context(full_code, missing[missing_keys[0]])}
+        futures = {key: pool.submit(get_chunk_context, full_code, missing[key]) for key in missing_keys[1:]}
+        generated.update((key, future.result()) for key, future in futures.items())
+        if cache:
+            cache.put_many({key: context.encode('utf-8') for key, context in generated.items()})
+        found.update(generated)
+    return [found[key] for key in keys]
+
+
 def get_chunk_context(full_code: str, chunk: str) -> str:
     """
     Uses Claude Haiku to generate context for a given code chunk.
-    Rate limited to 1000 requests per minute.
+    Rate limited to 900 requests per minute by default, with retries when throttled.
     """
     DOCUMENT_CONTEXT_PROMPT = """
     <document>
@@ -100,51 +435,57 @@ def get_chunk_context(full_code: str, chunk: str) -> str:
     Please give a short succinct context to situate this chunk within the overall document for the purposes of improving search retrieval of the chunk.
     Answer only with the succinct context and nothing else.
     """
-    limiter.try_acquire('get_chunk_context', 1)
-    response = client.beta.prompt_caching.messages.create(
-        model="claude-3-haiku-20240307",
-        max_tokens=1024,
-        temperature=0.0,
-        messages=[
-            {
-                "role": "user", 
-                "content": [
-                    {
-                        "type": "text",
-                        "text": DOCUMENT_CONTEXT_PROMPT.format(doc_content=full_code),
-                        "cache_control": {"type": "ephemeral"}
-                    },
-                    {
-                        "type": "text",
-                        "text": CHUNK_CONTEXT_PROMPT.format(chunk_content=chunk),
-                    }
-                ]
-            }
-        ],
-        extra_headers={"anthropic-beta": "prompt-caching-2024-07-31"}
-    )
+    with metrics.span('context.request', nbytes=len(full_code) + len(chunk)):
+        raw_response = limiter.call(
+            get_client().beta.prompt_caching.messages.with_raw_response.create,
+            tokens=estimate_tokens(full_code) + estimate_tokens(chunk),
+            model="claude-3-haiku-20240307",
+            max_tokens=1024,
+            temperature=0.0,
+            messages=[
+                {
+                    "role": "user", 
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": DOCUMENT_CONTEXT_PROMPT.format(doc_content=full_code),
+                            "cache_control": {"type": "ephemeral"}
+                        },
+                        {
+                            "type": "text",
+                            "text": CHUNK_CONTEXT_PROMPT.format(chunk_content=chunk),
+                        }
+                    ]
+                }
+            ],
+            extra_headers={"anthropic-beta": "prompt-caching-2024-07-31"}
+        )
+    limiter.observe_headers(raw_response.headers)
+    response = raw_response.parse()
 
     return response.content[0].text.strip()
 
+def expand_paths(paths):
+    """Expands directories in `paths` into the indexable files under them."""
+    for path in paths:
+        if os.path.isdir(path):
+            yield from get_indexable_files(path)
+        else:
+            yield path
+
+
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python chunking.py <filename>")
-        sys.exit(1)
-
-    filename = sys.argv[1]
-    try:
-        with open(filename, 'r') as file:
-            code = file.read()
-    except IOError:
-        print(f"Error: Unable to read file '{filename}'")
-        sys.exit(1)
-
-    language = infer_language(filename)
-    chunks = chunkify_code(code, language)
-
-    print(f"Chunks {filename} (inferred language: {language}):")
-    print("-" * 80)
-    for i, chunk in enumerate(chunks, 1):
-        print(f"Chunk {i}:")
-        print(chunk)
+    import argparse
+    parser = argparse.ArgumentParser(description="Chunk files or directories.")
+    parser.add_argument("paths", nargs='+', help="Files or directories to chunk")
+    parser.add_argument("--workers", type=int, help="Number of worker processes (default: number of CPUs)")
+    args = parser.parse_args()
+
+    for filename, chunks in chunkify_files(list(expand_paths(args.paths)), args.workers):
+        language = infer_language(filename)
+        print(f"Chunks {filename} (inferred language: {language}):")
         print("-" * 80)
+        for i, chunk in enumerate(chunks, 1):
+            print(f"Chunk {i}:")
+            print(chunk)
+            print("-" * 80)
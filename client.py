@@ -0,0 +1,55 @@
+import json
+import os
+import socket
+
+import db
+from util import ase_home
+
+
+def socket_path():
+    """The Unix socket `ase serve` listens on; override with ASE_SOCKET."""
+    return os.environ.get('ASE_SOCKET') or os.path.join(ase_home(), 'ase.sock')
+
+
+def request(message, path=None):
+    """
+    Send one request to a running `ase serve` daemon and return its response, or None if
+    no daemon is listening.  Errors reported by the daemon are raised as RuntimeError.
+    """
+    path = path or socket_path()
+    if not os.path.exists(path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+            with sock.makefile('rb') as f:
+                line = f.readline()
+    except (ConnectionRefusedError, FileNotFoundError):
+        # stale socket file from a daemon that is no longer running
+        return None
+    response = json.loads(line)
+    if 'error' in response:
+        raise RuntimeError(f"ase serve: {response['error']}")
+    return response
+
+
+def search(collection, query, limit, nprobe=None):
+    """Search through the daemon; returns the list of results, or None if no daemon is running."""
+    response = request({'command': 'search', 'collection': collection, 'query': query,
+                        'limit': limit, 'nprobe': nprobe, 'backend': db.backend_name()})
+    return response['results'] if response is not None else None
+
+
+def search_batch(collection, queries, limit, nprobe=None):
+    """Search for each of the queries through the daemon; returns a list of result lists."""
+    response = request({'command': 'search_batch', 'collection': collection, 'queries': queries,
+                        'limit': limit, 'nprobe': nprobe, 'backend': db.backend_name()})
+    return response['results'] if response is not None else None
+
+
+def search_collections(collections, query, limit, nprobe=None):
+    """Search all of the collections through the daemon; returns the merged results, or None if no daemon is running."""
+    response = request({'command': 'search_collections', 'collections': collections, 'query': query,
+                        'limit': limit, 'nprobe': nprobe, 'backend': db.backend_name()})
+    return response['results'] if response is not None else None
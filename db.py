@@ -1,86 +1,253 @@
+import fnmatch
+import heapq
 import os
-from astrapy import DataAPIClient
-from astrapy.constants import VectorMetric
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import metrics
+from lexical import LexicalIndex
+from manifest import Manifest
 from util import hexdigest
 
-# set up api endpoint and secret token
-_client = DataAPIClient(token=os.environ["ASTRA_DB_TOKEN"])
-_db = _client.get_database(os.environ["ASTRA_DB_ID"])
-
-_embeddings = None
-_files = None
+# The storage backend is chosen with ASE_DB: 'astra' (the default) or 'local'
+BACKENDS = ('astra', 'local')
+
+_store = None
+_manifest = None
+_lexical = None
+# file_id -> path, for search results from chunks stored without their path
+_paths = {}
+# stores opened by search_collections, by collection name, with their file_id -> path caches
+_collection_stores = {}
+_collection_stores_lock = threading.Lock()
+# collections searched at once by search_collections
+FANOUT_WORKERS = int(os.environ.get('ASE_FANOUT_WORKERS', 32))
+
+
+def backend_name():
+    return os.environ.get('ASE_DB', 'astra')
+
+
+def open_store(collection_name, backend=None):
+    """Return a store for the given collection using `backend`, by default the one selected by ASE_DB."""
+    backend = backend or backend_name()
+    if backend == 'astra':
+        from astra_store import AstraStore
+        return AstraStore(collection_name)
+    if backend == 'local':
+        from local_store import LocalStore
+        return LocalStore(collection_name)
+    raise ValueError(f"Unknown ASE_DB backend {backend!r}; expected one of {', '.join(BACKENDS)}")
+
+
+def list_collections(backend=None):
+    """Return the names of the collections in `backend`, by default the one selected by ASE_DB."""
+    backend = backend or backend_name()
+    if backend == 'astra':
+        from astra_store import list_collections
+        return list_collections()
+    if backend == 'local':
+        from local_store import list_collections
+        return list_collections()
+    raise ValueError(f"Unknown ASE_DB backend {backend!r}; expected one of {', '.join(BACKENDS)}")
+
+
+def resolve_collections(names):
+    """
+    Expand a comma-separated list of collection names and glob patterns (like `web-*`) into
+    the names of collections.  Every name must be an existing collection, since opening a
+    store creates its collection if it doesn't exist.
+    """
+    available = list_collections()
+    resolved = []
+    for name in filter(None, (name.strip() for name in names.split(','))):
+        if not any(c in name for c in '*?['):
+            if name not in available:
+                raise ValueError(f'No collection named {name!r}; run `ase index` to create it')
+            resolved.append(name)
+            continue
+        matches = fnmatch.filter(available, name)
+        if not matches:
+            raise ValueError(f'No collections match {name!r}')
+        resolved.extend(matches)
+    return list(dict.fromkeys(resolved))
 
 
 def init(collection_name):
     """
-    Create the embeddings and files collections if they don't exist.
+    Open the given collection, creating it if it doesn't exist.
     """
-    global _embeddings, _files
-    print('Connecting to database for collection ' + collection_name)
-    
-    embeddings_collection_name = collection_name + "_embeddings"
-    files_collection_name = collection_name + "_files"
-    
-    collections = set(c.name for c in _db.list_collections())
+    global _store, _manifest, _lexical
+    _store = open_store(collection_name)
+    _manifest = Manifest(backend_name(), collection_name)
+    _lexical = open_lexical(collection_name)
+    _paths.clear()
 
-    if embeddings_collection_name in collections:
-        _embeddings = _db[embeddings_collection_name]
-    else:
-        _embeddings = _db.create_collection(embeddings_collection_name,
-                                            indexing={'deny': ['chunk']},
-                                            dimension=768,
-                                            metric=VectorMetric.COSINE)
 
-    if files_collection_name in collections:
-        _files = _db[files_collection_name]
-    else:
-        _files = _db.create_collection(files_collection_name)
+def open_lexical(collection_name):
+    """Return the local lexical index for the collection; this doesn't connect to the database."""
+    return LexicalIndex(backend_name(), collection_name)
+
+
+def ensure_lexical(progress=None):
+    """
+    Build the lexical index from the stored chunks if it hasn't been built yet, e.g. for a
+    collection indexed before lexical search existed.  `progress` wraps the file iteration.
+    """
+    if _lexical.built:
+        return
+    file_docs = list(known_files().values())
+    for file_doc in (progress(file_docs) if progress else file_docs):
+        _lexical.remove_file(file_doc['_id'])
+        chunks = [doc['chunk'] for doc in _store.get_chunks_by_file_id(file_doc['_id'])]
+        _lexical.add(file_doc['_id'], file_doc['path'], chunks)
+    _lexical.mark_built()
+
+
+def known_files(resync=False):
+    """
+    Return a dict of path -> file document for every indexed file, from the local manifest.
+    The manifest is loaded from the files collection the first time, or if resync is set.
+    """
+    if resync or not _manifest.synced:
+        _manifest.sync(_store.hashes_cursor())
+    return _manifest.files()
 
 
 def hashes_cursor():
     """Return all documents in the files collection."""
-    return _files.find({})
+    return _store.hashes_cursor()
 
 
 def file_by_id(file_id):
     """Return the document with the given id. Raises an exception if not found."""
-    return _files.find_one({'_id': file_id})
+    return _store.file_by_id(file_id)
 
 
 def delete(file_id):
     """Delete the file and embeddings documents associated with the given file"""
-    _embeddings.delete_many({"file_id": file_id})
-    _files.delete_one({"_id": file_id})
+    with metrics.span('db.delete'):
+        _store.delete(file_id)
+    _manifest.remove(file_id)
+    _lexical.remove_file(file_id)
 
 
-def insert(file_id, full_path, chunks, encoded_chunks):
+def delete_many(file_ids):
+    """Delete the files with the given ids and their embeddings, batching the deletes where the backend can"""
+    file_ids = list(file_ids)
+    with metrics.span('db.delete_many'):
+        _store.delete_many(file_ids)
+    for file_id in file_ids:
+        _manifest.remove(file_id)
+        _lexical.remove_file(file_id)
+
+
+def insert(file_id, full_path, chunks, encoded_chunks, file_hash=None, stat=None):
     """
     Insert the file and embeddings documents associated with the given file.
-    If file_id is None, a new id is generated.
-    """
-    file_doc = {"path": full_path, "hash": hexdigest(full_path)}
-    if file_id:
-        file_doc["_id"] = file_id
-    result = _files.insert_one(file_doc)
-    file_id = result.inserted_id
-    
-    embeddings_docs = [{'file_id': file_id, 'chunk': chunk, '$vector': embedding}
-                       for chunk, embedding in zip(chunks, encoded_chunks)]
-    # call insert_many once per batch of 20 embeddings
-    for i in range(0, len(embeddings_docs), 20):
-        _embeddings.insert_many(embeddings_docs[i:i + 20])
-
-
-def search(query_embedding, limit):
-    """Return the top `limit` chunks that are most similar to the given query embedding."""
-    return _embeddings.find(
-        {},
-        sort={"$vector": query_embedding},
-        limit=limit,
-        projection={"file_id": 1, "chunk": 1}
-    )
+    If file_id is None, a new id is generated.  Pass the file's hash and the stat it was
+    hashed with, if known, to save reading the file again.
+    """
+    file_hash, stat = _hash_and_stat(full_path, file_hash, stat)
+    with metrics.span('db.insert'):
+        file_id = _store.insert(file_id, full_path, file_hash, chunks, encoded_chunks)
+    metrics.record('db.chunks_written', n=len(chunks))
+    _manifest.put(file_id, full_path, file_hash, stat)
+    _lexical.add(file_id, full_path, chunks)
+
+
+def update(file_id, full_path, chunks, encoded_chunks, removed_chunks, file_hash=None, stat=None):
+    """
+    Replace only the changed chunks of an already-indexed file: delete the chunks in
+    removed_chunks (a dict of chunk hash -> chunk ids, like get_chunk_hashes returns),
+    insert the new chunks, and update the file's hash.
+    """
+    file_hash, stat = _hash_and_stat(full_path, file_hash, stat)
+    removed_ids = [chunk_id for ids in removed_chunks.values() for chunk_id in ids]
+    with metrics.span('db.update'):
+        _store.update(file_id, full_path, file_hash, chunks, encoded_chunks, removed_ids)
+    metrics.record('db.chunks_written', n=len(chunks))
+    _manifest.put(file_id, full_path, file_hash, stat)
+    _lexical.remove_chunks(file_id, [chunk_hash for chunk_hash, ids in removed_chunks.items() for _ in ids])
+    _lexical.add(file_id, full_path, chunks)
+
+
+def touch(file_doc, stat):
+    """Record that an indexed file whose hash is unchanged now has the given stat."""
+    _manifest.put(file_doc['_id'], file_doc['path'], file_doc['hash'], stat)
+
+
+def _hash_and_stat(full_path, file_hash, stat):
+    if file_hash is None:
+        # stat first, so a write racing with the hash leaves a stale mtime, not a stale hash
+        stat = os.stat(full_path)
+        file_hash = hexdigest(full_path)
+    return file_hash, stat
+
+
+def get_chunk_hashes(file_id):
+    """Return a dict mapping chunk hash to the ids of the stored chunks of the file with that hash."""
+    with metrics.span('db.chunk_hashes'):
+        return _store.get_chunk_hashes(file_id)
+
+
+def search(query_embedding, limit, nprobe=None):
+    """
+    Return the top `limit` chunks that are most similar to the given query embedding.
+    nprobe is the number of index partitions to scan (local backend only; 0 for exact search).
+    """
+    with metrics.span('db.search'):
+        return with_paths(_store, list(_store.search(query_embedding, limit, nprobe)))
+
+
+def _open_collection(collection_name):
+    with _collection_stores_lock:
+        if collection_name not in _collection_stores:
+            _collection_stores[collection_name] = (open_store(collection_name), {})
+        return _collection_stores[collection_name]
+
+
+def search_collections(collection_names, query_embedding, limit, nprobe=None, open_collection=_open_collection):
+    """
+    Search every one of the collections concurrently, and return the overall top `limit`
+    chunks by similarity, each labeled with its 'collection'.  `open_collection` returns
+    the store and path cache for a collection name.
+    """
+    def search_one(collection_name):
+        store, paths = open_collection(collection_name)
+        with metrics.span('db.search'):
+            results = with_paths(store, list(store.search(query_embedding, limit, nprobe)), paths)
+        return [dict(result, collection=collection_name) for result in results]
+
+    with ThreadPoolExecutor(max(1, min(FANOUT_WORKERS, len(collection_names)))) as executor:
+        results = [result for results in executor.map(search_one, collection_names) for result in results]
+    return heapq.nlargest(limit, results, key=lambda result: result.get('$similarity') or 0)
+
+
+def with_paths(store, results, paths=_paths):
+    """
+    Make sure every result has a 'path'.  Chunks indexed before paths were stored on
+    them are resolved with one bulk files lookup, cached in `paths`.
+    """
+    missing = {result['file_id'] for result in results if not result.get('path')} - paths.keys()
+    if missing:
+        paths.update((doc['_id'], doc['path']) for doc in store.files_by_ids(missing))
+    for result in results:
+        if not result.get('path'):
+            result['path'] = paths.get(result['file_id'])
+    return results
+
+
+def evaluate(n_queries, limit, configs, max_rows):
+    """
+    Measure the recall of compact storage configs, a list of (dims, quantization) pairs,
+    on a sample of the collection.  Only the local backend supports this.
+    """
+    if backend_name() != 'local':
+        raise ValueError('Evaluating compact storage requires the local backend (ASE_DB=local)')
+    return _store.evaluate(n_queries, limit, configs, max_rows)
+
 
 def get_chunks_by_file_id(file_id):
     """Return all chunks associated with the given file_id."""
-    return list(_embeddings.find({"file_id": file_id}, projection={"chunk": 1, "_id": 0}))
+    return _store.get_chunks_by_file_id(file_id)
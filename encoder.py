@@ -1,17 +1,170 @@
-import google.generativeai as gemini
-from pyrate_limiter import Duration, Rate, Limiter
+import os
+from array import array
+from collections import defaultdict
+from concurrent.futures import Future
+
+import metrics
+from batching import Dispatcher, Submission
+from cache import DiskCache
+from ratelimit import RateLimiter
+from util import estimate_tokens, text_hash
+
+# 59 requests per minute by default; an optional tokens-per-minute quota can be set too
+limiter = RateLimiter('gemini-embed', int(os.environ.get('ASE_EMBED_RPM', 59)),
+                      int(os.environ.get('ASE_EMBED_TPM', 0)) or None)
+
+MODEL = "models/text-embedding-004"
+# batchEmbedContents accepts at most 100 inputs per request; the token budget is a
+# conservative estimate that keeps requests well under the API's payload limits
+MAX_BATCH_INPUTS = int(os.environ.get('ASE_EMBED_BATCH_INPUTS', 100))
+MAX_BATCH_TOKENS = int(os.environ.get('ASE_EMBED_BATCH_TOKENS', 50000))
+
+# Embeddings are cached on disk keyed by (model, sha256 of the input), so re-indexing
+# unchanged code doesn't cost any API calls.  Set ASE_EMBEDDING_CACHE_MB=0 to disable.
+_cache = None
+
+
+def gemini():
+    """The Gemini SDK, imported on first use since importing it takes most of a second."""
+    import google.generativeai
+    return google.generativeai
+
+
+def _get_cache():
+    global _cache
+    max_mb = int(os.environ.get('ASE_EMBEDDING_CACHE_MB', 2048))
+    if max_mb <= 0:
+        return None
+    if _cache is None:
+        _cache = DiskCache('embeddings', max_mb * 1024 * 1024)
+    return _cache
+
+
+def _cache_key(text: str) -> str:
+    return MODEL + ':' + text_hash(text)
 
-# Create a limiter with a rate of 59 requests per 60 seconds
-limiter = Limiter(Rate(59, Duration.MINUTE))
 
 def encode(inputs: list[str]) -> list[list[float]]:
-    limiter.try_acquire('encode', len(inputs))
+    keys, found, missing = _lookup(inputs)
+    if missing:
+        texts = list(missing.values())
+        found.update(_store(list(missing), _embed_batched(texts)))
+    return [found[key] for key in keys]
+
+
+def _lookup(inputs):
+    """
+    Returns the cache key of each input, the embeddings found in the cache by key,
+    and the distinct inputs that still need to be embedded, by key.
+    """
+    keys = [_cache_key(text) for text in inputs]
+    cache = _get_cache()
+    found = {}
+    if cache is not None:
+        found = {key: array('f', value).tolist() for key, value in cache.get_many(keys).items()}
+    missing = {}
+    for key, text in zip(keys, inputs):
+        if key not in found:
+            missing.setdefault(key, text)
+    metrics.record('embed.cache_hits', n=len(keys) - len(missing))
+    return keys, found, missing
+
+
+def _store(keys, embeddings):
+    cache = _get_cache()
+    if cache is not None:
+        cache.put_many({key: array('f', embedding).tobytes() for key, embedding in zip(keys, embeddings)})
+    return dict(zip(keys, embeddings))
+
 
+def pack(texts: list[str]) -> list[list[int]]:
+    """
+    Split the indexes of `texts` into consecutive groups that each fit in one embedding
+    request.  An input that is over the token budget by itself gets a request of its own.
+    """
+    batches = []
+    batch, batch_tokens = [], 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if batch and (len(batch) >= MAX_BATCH_INPUTS or batch_tokens + tokens > MAX_BATCH_TOKENS):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _embed_batched(inputs: list[str]) -> list[list[float]]:
+    embeddings = []
+    for batch in pack(inputs):
+        embeddings.extend(_embed([inputs[i] for i in batch]))
+    return embeddings
+
+
+def _embed(inputs: list[str]) -> list[list[float]]:
     # write the request to a file for debugging
     with open('/tmp/request.json', 'w') as f:
         import json
         f.write(json.dumps(inputs, indent=2))
 
-    model = "models/text-embedding-004"
-    result = gemini.embed_content(model=model, content=inputs)
+    with metrics.span('embed.request', nbytes=sum(len(text) for text in inputs)):
+        result = limiter.call(gemini().embed_content, model=MODEL, content=inputs,
+                              tokens=sum(estimate_tokens(text) for text in inputs))
+    metrics.record('embed.inputs', n=len(inputs))
     return result['embedding']
+
+
+class _Submission(Submission):
+    def __init__(self, keys, found, n):
+        super().__init__(n)
+        self.keys = keys
+        self.found = found
+
+    def result(self):
+        return [self.found[key] for key in self.keys]
+
+    def resolve(self, embeddings_by_key):
+        self.found.update(embeddings_by_key)
+        super().resolve(len(embeddings_by_key))
+
+
+class Batcher(Dispatcher):
+    """
+    Packs the chunks of many files into as few embedding requests as possible.
+
+    Callers (typically one thread per file) call `encode(chunks)`, which blocks until all
+    of the chunks have been embedded.  Chunks that aren't cached are packed together with
+    those of concurrent callers into requests of up to MAX_BATCH_INPUTS inputs and
+    MAX_BATCH_TOKENS tokens, with at most `max_inflight` requests outstanding.  A partially
+    filled request is sent once no new chunks have arrived for `linger` seconds.
+    """
+
+    def __init__(self, max_inflight=4, linger=0.05):
+        super().__init__('embed', MAX_BATCH_INPUTS, MAX_BATCH_TOKENS, lambda item: estimate_tokens(item[1]),
+                         max_inflight, linger)
+
+    def submit(self, chunks: list[str]) -> Future:
+        """Queue `chunks` for embedding; the returned future resolves to their embeddings."""
+        keys, found, missing = _lookup(chunks)
+        submission = _Submission(keys, found, len(missing))
+        if not missing:
+            submission.future.set_result(submission.result())
+            return submission.future
+        self._enqueue(submission, list(missing.items()))
+        return submission.future
+
+    def encode(self, chunks: list[str]) -> list[list[float]]:
+        with metrics.span('embed.wait'):
+            return self.submit(chunks).result()
+
+    def _send(self, batch):
+        # the same chunk may be pending for two files; embed it once
+        texts = dict(item for _, item, _ in batch)
+        embeddings = _store(list(texts), _embed(list(texts.values())))
+        by_submission = defaultdict(dict)
+        for submission, (key, _), _ in batch:
+            by_submission[submission][key] = embeddings[key]
+        for submission, embeddings_by_key in by_submission.items():
+            submission.resolve(embeddings_by_key)
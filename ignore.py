@@ -0,0 +1,106 @@
+import os
+import re
+
+# Directories that are never worth indexing: VCS metadata, dependencies, virtualenvs and build output
+# Names too generic to ignore everywhere (src/env/, cmd/build/ can be real source) are
+# only ignored at the root of the tree
+DEFAULT_IGNORES = [
+    '.git/', '.hg/', '.svn/', 'node_modules/', 'bower_components/', 'vendor/', 'target/',
+    'venv/', '.venv/', '/env/', '__pycache__/', '.tox/', '.nox/', '.mypy_cache/', '.pytest_cache/',
+    '/build/', '/dist/', '/out/', '.gradle/', '.idea/', '*.egg-info/', '*.min.js',
+]
+
+# Per-directory ignore files, applied like .gitignore
+IGNORE_FILES = ('.gitignore', '.aseignore')
+
+
+def _translate(pattern):
+    """Translate a gitignore glob into a regex over '/'-separated relative paths."""
+    i, n = 0, len(pattern)
+    out = []
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            out.append('.*')
+            i += 2
+        elif c == '*':
+            out.append('[^/]*')
+            i += 1
+        elif c == '?':
+            out.append('[^/]')
+            i += 1
+        elif c == '[':
+            j = pattern.find(']', i + 1)
+            if j == -1:
+                out.append(re.escape(c))
+                i += 1
+            else:
+                body = pattern[i + 1:j]
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                out.append('[' + body.replace('\\', '\\\\') + ']')
+                i = j + 1
+        elif c == '\\' and i + 1 < n:
+            out.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            out.append(re.escape(c))
+            i += 1
+    return ''.join(out)
+
+
+class IgnoreRules:
+    """The patterns from one ignore file, relative to the directory that contains it."""
+
+    def __init__(self, base, lines):
+        self.base = base
+        self.patterns = []  # (regex, negated, dir_only)
+        for line in lines:
+            line = line.rstrip('\n')
+            if not line.endswith('\\ '):
+                line = line.rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            # a pattern with a slash anywhere but the end is relative to the base directory;
+            # otherwise it matches at any depth
+            anchored = '/' in line
+            line = line.lstrip('/')
+            regex = _translate(line) if anchored else '(?:.*/)?' + _translate(line)
+            self.patterns.append((re.compile(regex + r'\Z', re.DOTALL), negated, dir_only))
+
+    @classmethod
+    def load(cls, directory, name):
+        try:
+            with open(os.path.join(directory, name), 'r', encoding='utf-8', errors='replace') as f:
+                return cls(directory, f.readlines())
+        except OSError:
+            return None
+
+    def match(self, full_path, is_dir):
+        """Return True (ignored), False (explicitly re-included) or None (no pattern matched)."""
+        relative = os.path.relpath(full_path, self.base).replace(os.sep, '/')
+        result = None
+        for regex, negated, dir_only in self.patterns:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relative):
+                result = not negated
+        return result
+
+
+def is_ignored(rules, full_path, is_dir):
+    """Apply a stack of rules, outermost first; as in git, the last matching pattern wins."""
+    ignored = False
+    for rule in rules:
+        result = rule.match(full_path, is_dir)
+        if result is not None:
+            ignored = result
+    return ignored
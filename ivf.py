@@ -0,0 +1,111 @@
+import os
+
+import numpy as np
+
+# collections smaller than this are searched exhaustively
+MIN_TRAIN_ROWS = int(os.environ.get('ASE_IVF_MIN_ROWS', 50000))
+# the index is retrained once the collection has grown this much since the last training
+RETRAIN_GROWTH = 4
+DEFAULT_NPROBE = int(os.environ.get('ASE_NPROBE', 16))
+
+
+def kmeans(vectors, k, iterations=10, seed=0):
+    """Spherical k-means over unit vectors; returns k unit-length centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        counts = np.bincount(labels, minlength=k)
+        # re-seed empty clusters from random points
+        empty = counts == 0
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    """
+    An inverted-file (IVF) approximate nearest neighbor index over the rows of a
+    LocalStore matrix.  Rows are partitioned by their nearest k-means centroid; a search
+    only scores the rows in the `nprobe` partitions whose centroids are closest to the query.
+
+    The partition of every row is kept in a memory-mapped int32 array parallel to the
+    vectors matrix (-1 for unassigned rows), which is the source of truth; the in-memory
+    lists are rebuilt from it on open and appended to as rows are assigned.  Entries left
+    behind by deleted or reused rows are filtered out at search time.
+    """
+
+    def __init__(self, path):
+        self._centroids_path = os.path.join(path, 'centroids.npy')
+        self._assignments_path = os.path.join(path, 'assignments.i32')
+        self.centroids = np.load(self._centroids_path) if os.path.exists(self._centroids_path) else None
+        self.trained_rows = 0
+        self._assignments = None
+        self._lists = []
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def resize(self, capacity):
+        """Map the assignments array, growing it to `capacity` rows."""
+        size = os.path.getsize(self._assignments_path) if os.path.exists(self._assignments_path) else 0
+        if size < capacity * 4:
+            with open(self._assignments_path, 'ab') as f:
+                f.write(np.full(capacity - size // 4, -1, dtype=np.int32).tobytes())
+        self._assignments = np.memmap(self._assignments_path, dtype=np.int32, mode='r+', shape=(capacity,))
+        if self.trained and not self._lists:
+            self._build_lists()
+
+    def _build_lists(self):
+        order = np.argsort(self._assignments, kind='stable')
+        bounds = np.searchsorted(self._assignments[order], np.arange(len(self.centroids) + 1))
+        self._lists = [[order[bounds[i]:bounds[i + 1]]] for i in range(len(self.centroids))]
+        self.trained_rows = int((self._assignments >= 0).sum())
+
+    def train(self, vectors, rows):
+        """Cluster the given live rows and (re)assign all of them."""
+        nlist = max(1, int(np.sqrt(len(rows))))
+        sample = rows
+        if len(rows) > nlist * 32:
+            sample = np.sort(np.random.default_rng(0).choice(rows, nlist * 32, replace=False))
+        self.centroids = kmeans(np.asarray(vectors[sample]), nlist)
+        np.save(self._centroids_path, self.centroids)
+        self._assignments[:] = -1
+        for i in range(0, len(rows), 65536):
+            block = rows[i:i + 65536]
+            self._assignments[block] = self._nearest(np.asarray(vectors[block]))
+        self._assignments.flush()
+        self._build_lists()
+
+    def _nearest(self, vectors):
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def add(self, rows, vectors):
+        """Assign newly written rows to their partitions."""
+        if not self.trained or not len(rows):
+            return
+        labels = self._nearest(vectors)
+        self._assignments[rows] = labels
+        self._assignments.flush()
+        for label in np.unique(labels):
+            self._lists[label].append(rows[labels == label])
+
+    def remove(self, rows):
+        if self._assignments is not None and len(rows):
+            self._assignments[rows] = -1
+
+    def candidates(self, query, nprobe):
+        """Return the rows in the `nprobe` partitions closest to the query."""
+        probe = np.argsort(-(self.centroids @ query))[:nprobe]
+        found = []
+        for label in probe:
+            parts = self._lists[label]
+            rows = np.concatenate(parts) if len(parts) > 1 else parts[0]
+            # drop stale entries for rows that were since deleted or moved to another partition
+            rows = rows[self._assignments[rows] == label]
+            parts[:] = [rows]
+            found.append(rows)
+        return np.unique(np.concatenate(found)) if found else np.zeros(0, dtype=np.int64)
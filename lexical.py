@@ -0,0 +1,118 @@
+import os
+import re
+import sqlite3
+import threading
+
+from util import ase_home, text_hash
+
+_IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*|[0-9]+')
+# boundaries inside identifiers: fooBar, FOOBar, foo_bar, foo2
+_SUBWORD = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+')
+
+
+def tokenize(text):
+    """
+    Split code into lowercase search terms: each identifier, plus the words inside it,
+    so `ConnectionPool.acquire` yields connectionpool, connection, pool and acquire.
+    """
+    tokens = []
+    for identifier in _IDENTIFIER.findall(text):
+        tokens.append(identifier.lower())
+        parts = _SUBWORD.findall(identifier)
+        if len(parts) > 1:
+            tokens.extend(part.lower() for part in parts)
+    return tokens
+
+
+class LexicalIndex:
+    """
+    A BM25 inverted index over chunk text, kept in SQLite FTS5 under ASE_HOME alongside a
+    collection's embeddings.  It answers identifier lookups locally, with no embedding call.
+    db.py keeps it in step with the store on every insert, update and delete.
+    """
+
+    def __init__(self, backend, collection_name):
+        directory = os.path.join(ase_home(), 'lexical')
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(directory, f'{backend}-{collection_name}.sqlite'),
+                                     check_same_thread=False)
+        self._conn.executescript('''
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, file_id TEXT NOT NULL, path TEXT NOT NULL,
+                                               chunk_hash TEXT NOT NULL, chunk TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS chunks_file_id ON chunks (file_id, chunk_hash);
+            CREATE VIRTUAL TABLE IF NOT EXISTS terms USING fts5(tokens, tokenize="unicode61 tokenchars '_'");
+        ''')
+        self._conn.commit()
+
+    @property
+    def built(self):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM meta WHERE key = 'built'").fetchone() is not None
+
+    def mark_built(self):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('built', '1')")
+            self._conn.commit()
+
+    def add(self, file_id, full_path, chunks):
+        with self._lock:
+            for chunk in chunks:
+                cursor = self._conn.execute('INSERT INTO chunks (file_id, path, chunk_hash, chunk) VALUES (?, ?, ?, ?)',
+                                            (str(file_id), full_path, text_hash(chunk), chunk))
+                self._conn.execute('INSERT INTO terms (rowid, tokens) VALUES (?, ?)',
+                                   (cursor.lastrowid, ' '.join(tokenize(chunk))))
+            self._conn.commit()
+
+    def remove_chunks(self, file_id, chunk_hashes):
+        """Remove one chunk of the file for each of the given chunk hashes."""
+        with self._lock:
+            for chunk_hash in chunk_hashes:
+                row = self._conn.execute('SELECT id FROM chunks WHERE file_id = ? AND chunk_hash = ? LIMIT 1',
+                                         (str(file_id), chunk_hash)).fetchone()
+                if row:
+                    self._delete_ids([row[0]])
+            self._conn.commit()
+
+    def remove_file(self, file_id):
+        with self._lock:
+            ids = [id for id, in self._conn.execute('SELECT id FROM chunks WHERE file_id = ?', (str(file_id),))]
+            self._delete_ids(ids)
+            self._conn.commit()
+
+    def _delete_ids(self, ids):
+        self._conn.executemany('DELETE FROM chunks WHERE id = ?', [(id,) for id in ids])
+        self._conn.executemany('DELETE FROM terms WHERE rowid = ?', [(id,) for id in ids])
+
+    def search(self, query, limit):
+        """Return the top `limit` chunks by BM25 score for the terms in the query."""
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        match = ' OR '.join(f'"{term}"' for term in terms)
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT chunks.file_id, chunks.path, chunks.chunk, bm25(terms) AS score FROM terms '
+                'JOIN chunks ON chunks.id = terms.rowid WHERE terms MATCH ? ORDER BY score LIMIT ?',
+                (match, limit)).fetchall()
+        # bm25() is lower-is-better; report it as a positive score
+        return [{'file_id': file_id, 'path': path, 'chunk': chunk, 'score': -score}
+                for file_id, path, chunk, score in rows]
+
+
+def fuse(ranked_lists, limit, k=60):
+    """
+    Merge several ranked result lists with reciprocal rank fusion.  Results are identified
+    by path and chunk text; each scores the sum of 1 / (k + rank) over the lists it is in.
+    """
+    scores = {}
+    results = {}
+    for ranked in ranked_lists:
+        for rank, result in enumerate(ranked):
+            key = (result['path'], result['chunk'])
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+            results.setdefault(key, result)
+    best = sorted(scores, key=scores.get, reverse=True)[:limit]
+    return [dict(results[key], score=scores[key]) for key in best]
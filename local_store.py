@@ -0,0 +1,323 @@
+import os
+import sqlite3
+import threading
+import uuid
+
+import numpy as np
+
+from ivf import DEFAULT_NPROBE, MIN_TRAIN_ROWS, RETRAIN_GROWTH, IVFIndex
+import quantize
+from quantize import RERANK_FACTOR, Codec, normalize, top_k
+from store import Store
+from util import ase_home, text_hash
+
+
+def _memmap(path, dtype, row_shape, capacity):
+    """Map a matrix file of `capacity` rows, growing the file if it is smaller."""
+    row_bytes = np.dtype(dtype).itemsize * int(np.prod(row_shape))
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if size < capacity * row_bytes:
+        with open(path, 'ab') as f:
+            f.truncate(capacity * row_bytes)
+    return np.memmap(path, dtype=dtype, mode='r+', shape=(capacity,) + tuple(row_shape))
+
+
+class _CompactView:
+    """The rows of a store's vectors, projected into its compact space, for IVF training."""
+
+    def __init__(self, codec, vectors, codes):
+        self._codec, self._vectors, self._codes = codec, vectors, codes
+
+    def __getitem__(self, rows):
+        if self._vectors is not None:
+            return self._codec.project(self._vectors[rows])
+        return self._codec.decode(self._codes[rows])
+
+
+def list_collections():
+    """Return the names of the local collections under ASE_HOME."""
+    directory = os.path.join(ase_home(), 'local')
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(name for name in names if os.path.exists(os.path.join(directory, name, 'meta.sqlite')))
+
+
+class LocalStore(Store):
+    """
+    Stores a collection on local disk under ASE_HOME/local/<collection>, with no service
+    dependency.  Embeddings live in a memory-mapped float32 matrix (one row per chunk,
+    normalized to unit length); files, chunks and the row each chunk occupies live in SQLite.
+    Rows freed by deletes are reused by later inserts.
+
+    Small collections are searched with an exact, vectorized cosine top-k over the matrix.
+    Once a collection reaches MIN_TRAIN_ROWS chunks, an IVF index is trained and kept up
+    to date by insert and delete, and searches only score the `nprobe` closest partitions.
+
+    A collection created with ASE_COMPACT_DIMS or ASE_QUANTIZATION set is compact: searches
+    score a matrix of truncated and/or quantized codes, and the full-precision vectors
+    aren't stored at all.  With ASE_RERANK=1 they are kept as well, and the best candidates
+    are reranked against them.
+    """
+
+    def __init__(self, collection_name):
+        self.path = os.path.join(ase_home(), 'local', collection_name)
+        os.makedirs(self.path, exist_ok=True)
+        self._vectors_path = os.path.join(self.path, 'vectors.f32')
+        self._codes_path = os.path.join(self.path, 'codes.bin')
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(self.path, 'meta.sqlite'), check_same_thread=False)
+        self._conn.executescript('''
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS files (_id TEXT PRIMARY KEY, path TEXT NOT NULL, hash TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS chunks (row INTEGER PRIMARY KEY, file_id TEXT NOT NULL, chunk TEXT NOT NULL,
+                                               chunk_hash TEXT);
+            CREATE INDEX IF NOT EXISTS chunks_file_id ON chunks (file_id);
+        ''')
+        columns = [name for _, name, *_ in self._conn.execute('PRAGMA table_info(chunks)')]
+        if 'chunk_hash' not in columns:
+            self._conn.execute('ALTER TABLE chunks ADD COLUMN chunk_hash TEXT')
+        self._conn.commit()
+        self._load()
+
+    def _load(self):
+        self._data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+        dimension = self._get_meta('dimension')
+        self._dimension = int(dimension) if dimension else None
+        quantization = self._get_meta('quantization')
+        self._codec = Codec(self._dimension, int(self._get_meta('compact_dims')), quantization) if quantization else None
+        # full-precision vectors are kept unless the collection is compact without rerank
+        self._keep_vectors = not self._codec or self._get_meta('rerank') == '1'
+        self._vectors = None
+        self._codes = None
+        self._live = np.zeros(0, dtype=bool)
+        self._rows = 0  # one past the highest live row
+        self._ivf = IVFIndex(self.path)
+        if self._dimension:
+            self._map_vectors()
+            live_rows = np.array([row for row, in self._conn.execute('SELECT row FROM chunks')], dtype=np.int64)
+            self._live[live_rows] = True
+            self._rows = int(live_rows.max()) + 1 if len(live_rows) else 0
+
+    def refresh(self):
+        """
+        Reload the in-memory state if another process has written to the collection since
+        it was loaded, so long-lived processes (ase serve) see concurrent index updates.
+        """
+        with self._lock:
+            if self._conn.execute('PRAGMA data_version').fetchone()[0] != self._data_version:
+                self._load()
+
+    def _get_meta(self, key):
+        row = self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self._conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def _configure(self, dimension):
+        """Record the dimension, and the compact storage settings, of a new collection."""
+        self._dimension = dimension
+        self._set_meta('dimension', dimension)
+        if quantize.COMPACT_DIMS or quantize.QUANTIZATION != 'float32':
+            self._codec = Codec(dimension, quantize.COMPACT_DIMS, quantize.QUANTIZATION)
+            self._keep_vectors = quantize.RERANK
+            self._set_meta('compact_dims', self._codec.dims)
+            self._set_meta('quantization', self._codec.quantization)
+            self._set_meta('rerank', int(self._keep_vectors))
+
+    def _map_vectors(self, min_capacity=0):
+        """(Re)map the vectors and codes files, growing them to hold at least min_capacity rows."""
+        if self._codec:
+            path, row_bytes = self._codes_path, self._codec.row_bytes
+        else:
+            path, row_bytes = self._vectors_path, self._dimension * 4
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        capacity = size // row_bytes
+        # numpy can't map an empty file
+        min_capacity = max(min_capacity, 1)
+        if capacity < min_capacity:
+            capacity = max(1024, 2 * capacity, min_capacity)
+        # readers holding the previous maps keep a valid view of the rows they snapshotted
+        if self._keep_vectors:
+            self._vectors = _memmap(self._vectors_path, np.float32, (self._dimension,), capacity)
+        if self._codec:
+            self._codes = _memmap(self._codes_path, self._codec.dtype, self._codec.row_shape, capacity)
+        live = np.zeros(capacity, dtype=bool)
+        live[:len(self._live)] = self._live
+        self._live = live
+        self._ivf.resize(capacity)
+
+    def _allocate(self, n):
+        """Return n free rows, reusing rows freed by deletes before growing the matrix."""
+        free = np.flatnonzero(~self._live)[:n]
+        if len(free) < n:
+            self._map_vectors(len(self._live) + n - len(free))
+            free = np.flatnonzero(~self._live)[:n]
+        return free
+
+    def hashes_cursor(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT _id, path, hash FROM files').fetchall()
+        return [{'_id': _id, 'path': path, 'hash': file_hash} for _id, path, file_hash in rows]
+
+    def file_by_id(self, file_id):
+        with self._lock:
+            row = self._conn.execute('SELECT _id, path, hash FROM files WHERE _id = ?', (file_id,)).fetchone()
+        return {'_id': row[0], 'path': row[1], 'hash': row[2]} if row else None
+
+    def files_by_ids(self, file_ids):
+        file_ids = list(file_ids)
+        placeholders = ','.join('?' * len(file_ids))
+        with self._lock:
+            rows = self._conn.execute(f'SELECT _id, path, hash FROM files WHERE _id IN ({placeholders})',
+                                      file_ids).fetchall()
+        return [{'_id': _id, 'path': path, 'hash': file_hash} for _id, path, file_hash in rows]
+
+    def delete(self, file_id):
+        with self._lock:
+            rows = [row for row, in self._conn.execute('SELECT row FROM chunks WHERE file_id = ?', (file_id,))]
+            self._conn.execute('DELETE FROM chunks WHERE file_id = ?', (file_id,))
+            self._conn.execute('DELETE FROM files WHERE _id = ?', (file_id,))
+            self._conn.commit()
+            self._live[rows] = False
+            self._ivf.remove(rows)
+
+    def insert(self, file_id, full_path, file_hash, chunks, encoded_chunks):
+        file_id = file_id or str(uuid.uuid4())
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO files (_id, path, hash) VALUES (?, ?, ?)',
+                               (file_id, full_path, file_hash))
+            self._insert_chunks(file_id, chunks, encoded_chunks)
+        return file_id
+
+    def update(self, file_id, full_path, file_hash, chunks, encoded_chunks, removed_chunk_ids):
+        with self._lock:
+            removed = [int(row) for row in removed_chunk_ids]
+            self._conn.executemany('DELETE FROM chunks WHERE row = ?', [(row,) for row in removed])
+            self._conn.execute('UPDATE files SET hash = ? WHERE _id = ?', (file_hash, file_id))
+            self._insert_chunks(file_id, chunks, encoded_chunks)
+            self._live[removed] = False
+            self._ivf.remove(removed)
+
+    def _insert_chunks(self, file_id, chunks, encoded_chunks):
+        """Write the chunks' vectors and rows and commit.  Must be called with the lock held."""
+        rows = []
+        if chunks:
+            vectors = normalize(encoded_chunks)
+            if self._dimension is None:
+                self._configure(vectors.shape[1])
+                self._map_vectors()
+            rows = self._allocate(len(chunks))
+            # vectors go to disk before the rows that reference them are committed,
+            # so SQLite never points at a row that wasn't written
+            if self._vectors is not None:
+                self._vectors[rows] = vectors
+                self._vectors.flush()
+            if self._codec:
+                self._codes[rows] = self._codec.encode(vectors)
+                self._codes.flush()
+        self._conn.executemany('INSERT INTO chunks (row, file_id, chunk, chunk_hash) VALUES (?, ?, ?, ?)',
+                               [(int(row), file_id, chunk, text_hash(chunk)) for row, chunk in zip(rows, chunks)])
+        self._conn.commit()
+        if len(rows):
+            self._live[rows] = True
+            self._rows = max(self._rows, int(rows.max()) + 1)
+            self._ivf.add(rows, self._codec.project(vectors) if self._codec else vectors)
+            self._maybe_train()
+
+    def get_chunk_hashes(self, file_id):
+        with self._lock:
+            rows = self._conn.execute('SELECT row, chunk, chunk_hash FROM chunks WHERE file_id = ?', (file_id,)).fetchall()
+        hashes = {}
+        for row, chunk, chunk_hash in rows:
+            hashes.setdefault(chunk_hash or text_hash(chunk), []).append(row)
+        return hashes
+
+    def _maybe_train(self):
+        n_live = int(self._live.sum())
+        if self._ivf.trained:
+            if n_live < RETRAIN_GROWTH * self._ivf.trained_rows:
+                return
+        elif n_live < MIN_TRAIN_ROWS:
+            return
+        vectors = _CompactView(self._codec, self._vectors, self._codes) if self._codec else self._vectors
+        self._ivf.train(vectors, np.flatnonzero(self._live))
+
+    def search(self, query_embedding, limit, nprobe=None):
+        """
+        Return the top `limit` chunks most similar to the query.  `nprobe` is the number of
+        IVF partitions to scan (more is slower but finds more of the true neighbors);
+        0 forces an exact search.
+        """
+        self.refresh()
+        query = normalize(query_embedding)
+        if nprobe is None:
+            nprobe = DEFAULT_NPROBE
+        with self._lock:
+            vectors, codes, codec, live, n = self._vectors, self._codes, self._codec, self._live, self._rows
+            # with a compact collection, candidates are found and scored in the compact space
+            compact_query = codec.project(query) if codec else query
+            candidates = self._ivf.candidates(compact_query, nprobe) if nprobe and self._ivf.trained else None
+        if self._dimension is None or n == 0:
+            return []
+        if codec:
+            matrix, score = codes, codec.score
+        else:
+            matrix, score = vectors, np.dot
+        if candidates is not None:
+            candidates = candidates[live[candidates]]
+        if candidates is not None and len(candidates) >= limit:
+            rows = candidates
+            scores = score(matrix[rows], compact_query)
+        else:
+            rows = np.arange(n)
+            scores = score(matrix[:n], compact_query)
+            scores[~live[:n]] = -np.inf
+            limit = min(limit, int(live[:n].sum()))
+        if limit <= 0:
+            return []
+        if codec and vectors is not None:
+            shortlist = top_k(scores, limit * RERANK_FACTOR)
+            rows = rows[shortlist[np.isfinite(scores[shortlist])]]
+            scores = vectors[rows] @ query
+        top = top_k(scores, limit)
+        return self._chunk_docs(rows[top], scores[top])
+
+    def _chunk_docs(self, rows, scores):
+        rows = [int(row) for row in rows]
+        placeholders = ','.join('?' * len(rows))
+        with self._lock:
+            found = {row: (file_id, path, chunk) for row, file_id, path, chunk in self._conn.execute(
+                'SELECT chunks.row, chunks.file_id, files.path, chunks.chunk FROM chunks '
+                f'JOIN files ON files._id = chunks.file_id WHERE chunks.row IN ({placeholders})', rows)}
+        # rows deleted since the matrix was scanned are skipped.  Similarity is reported
+        # on the same 0..1 scale as Astra's cosine metric.
+        return [{'_id': row, 'file_id': found[row][0], 'path': found[row][1], 'chunk': found[row][2],
+                 '$similarity': (1 + float(score)) / 2}
+                for row, score in zip(rows, scores) if row in found]
+
+    def evaluate(self, n_queries, limit, configs, max_rows=100000):
+        """
+        Report the recall of compact storage configs (see quantize.evaluate) on this
+        collection, using up to `max_rows` of its chunks and `n_queries` of them as queries.
+        """
+        self.refresh()
+        with self._lock:
+            vectors, live, n = self._vectors, self._live, self._rows
+        if vectors is None:
+            raise ValueError('The collection is compact and has no full-precision vectors to evaluate '
+                             'against; rebuild it (delete it and run ase index again) with ASE_RERANK=1 to keep them')
+        rng = np.random.default_rng(0)
+        rows = np.flatnonzero(live[:n])
+        if len(rows) > max_rows:
+            rows = np.sort(rng.choice(rows, max_rows, replace=False))
+        queries = rng.choice(len(rows), min(n_queries, len(rows)), replace=False)
+        return quantize.evaluate(vectors[rows], queries, limit, configs)
+
+    def get_chunks_by_file_id(self, file_id):
+        with self._lock:
+            rows = self._conn.execute('SELECT chunk FROM chunks WHERE file_id = ? ORDER BY row', (file_id,)).fetchall()
+        return [{'chunk': chunk} for chunk, in rows]
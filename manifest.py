@@ -0,0 +1,75 @@
+import os
+import sqlite3
+import threading
+
+from util import ase_home
+
+
+class Manifest:
+    """
+    A local record of the files indexed in one collection: path, file id, hash, and the
+    size and mtime the file had when it was hashed.  It lets `ase index` skip unchanged
+    files with a stat instead of reading and hashing them, and spares every command from
+    streaming the files collection from the database.
+
+    db.py keeps it in step with the store on every insert, update and delete.  It is
+    populated from the store the first time a collection is used on this machine; call
+    `sync` again if the collection was changed from elsewhere.
+    """
+
+    def __init__(self, backend, collection_name):
+        directory = os.path.join(ase_home(), 'manifests')
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(directory, f'{backend}-{collection_name}.sqlite'),
+                                     check_same_thread=False)
+        self._conn.executescript('''
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, _id TEXT NOT NULL, hash TEXT NOT NULL,
+                                              size INTEGER, mtime_ns INTEGER);
+            CREATE INDEX IF NOT EXISTS files_id ON files (_id);
+        ''')
+        self._conn.commit()
+
+    @property
+    def synced(self):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM meta WHERE key = 'synced'").fetchone() is not None
+
+    def sync(self, file_docs):
+        """Replace the manifest with the given file documents from the store."""
+        with self._lock:
+            # keep the recorded stats of files whose hash hasn't changed
+            stats = {(path, file_hash): (size, mtime_ns) for path, file_hash, size, mtime_ns
+                     in self._conn.execute('SELECT path, hash, size, mtime_ns FROM files')}
+            self._conn.execute('DELETE FROM files')
+            self._conn.executemany('INSERT OR REPLACE INTO files (path, _id, hash, size, mtime_ns) VALUES (?, ?, ?, ?, ?)',
+                                   [(doc['path'], str(doc['_id']), doc['hash'],
+                                     *stats.get((doc['path'], doc['hash']), (None, None)))
+                                    for doc in file_docs])
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('synced', '1')")
+            self._conn.commit()
+
+    def files(self):
+        """Return a dict of path -> file document (with '_id', 'path', 'hash', 'size' and 'mtime_ns')."""
+        with self._lock:
+            rows = self._conn.execute('SELECT path, _id, hash, size, mtime_ns FROM files').fetchall()
+        return {path: {'_id': _id, 'path': path, 'hash': file_hash, 'size': size, 'mtime_ns': mtime_ns}
+                for path, _id, file_hash, size, mtime_ns in rows}
+
+    def put(self, file_id, full_path, file_hash, stat):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO files (path, _id, hash, size, mtime_ns) VALUES (?, ?, ?, ?, ?)',
+                               (full_path, str(file_id), file_hash, stat.st_size, stat.st_mtime_ns))
+            self._conn.commit()
+
+    def remove(self, file_id):
+        with self._lock:
+            self._conn.execute('DELETE FROM files WHERE _id = ?', (str(file_id),))
+            self._conn.commit()
+
+
+def unchanged(file_doc, stat):
+    """True if the file still has the size and mtime it had when it was last hashed."""
+    return file_doc.get('size') == stat.st_size and file_doc.get('mtime_ns') == stat.st_mtime_ns
@@ -0,0 +1,102 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Collects timings, counts and byte totals from the stages of indexing and search, for
+# `ase index --profile` and `--metrics`.  Every hook is a no-op until `enable` is called.
+# Worker processes (ase index --chunk-processes) don't report back to the parent.
+
+ENABLED = False
+# keep at most this many trace events; the summary keeps counting after that
+MAX_TRACE_EVENTS = 1000000
+
+_lock = threading.Lock()
+_stats = {}  # name -> [count, total seconds, max seconds, bytes]
+_events = []
+_tracing = False
+_start = time.perf_counter()
+_NULL = nullcontext()
+
+
+def enable(trace=False):
+    """Start collecting; with trace=True, also keep every span for a Chrome trace."""
+    global ENABLED, _tracing, _start
+    with _lock:
+        _stats.clear()
+        _events.clear()
+        _tracing = trace
+        _start = time.perf_counter()
+        ENABLED = True
+
+
+def record(name, seconds=0.0, n=1, nbytes=0, start=None):
+    """Add `n` occurrences of `name` that took `seconds` and processed `nbytes` in total."""
+    if not ENABLED:
+        return
+    with _lock:
+        stat = _stats.get(name)
+        if stat is None:
+            stat = _stats[name] = [0, 0.0, 0.0, 0]
+        stat[0] += n
+        stat[1] += seconds
+        stat[2] = max(stat[2], seconds)
+        stat[3] += nbytes
+        if _tracing and start is not None and len(_events) < MAX_TRACE_EVENTS:
+            _events.append({'name': name, 'cat': name.split('.')[0], 'ph': 'X',
+                            'ts': (start - _start) * 1e6, 'dur': seconds * 1e6,
+                            'pid': os.getpid(), 'tid': threading.get_ident()})
+
+
+def span(name, nbytes=0):
+    """Context manager that records how long its block takes under `name`."""
+    if not ENABLED:
+        return _NULL
+    return _span(name, nbytes)
+
+
+@contextmanager
+def _span(name, nbytes):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start, nbytes=nbytes, start=start)
+
+
+def summary():
+    """Return a dict of name -> count, seconds, max_seconds and bytes."""
+    with _lock:
+        return {name: {'count': count, 'seconds': seconds, 'max_seconds': max_seconds, 'bytes': nbytes}
+                for name, (count, seconds, max_seconds, nbytes) in sorted(_stats.items())}
+
+
+def print_summary(wall_seconds=None, file=sys.stderr):
+    """Print a table of the metrics; to stderr by default, so it doesn't mix with command output."""
+    if wall_seconds is None:
+        wall_seconds = time.perf_counter() - _start
+    print(f"\n{'metric':<28} {'count':>9} {'busy s':>9} {'mean ms':>9} {'max ms':>9} {'MB':>9}", file=file)
+    for name, stat in summary().items():
+        megabytes = f"{stat['bytes'] / 1e6:.1f}" if stat['bytes'] else ''
+        if not stat['seconds']:
+            # a plain counter
+            print(f"{name:<28} {stat['count']:>9} {'':>9} {'':>9} {'':>9} {megabytes:>9}", file=file)
+            continue
+        mean = stat['seconds'] / stat['count'] * 1000 if stat['count'] else 0
+        print(f"{name:<28} {stat['count']:>9} {stat['seconds']:>9.2f} {mean:>9.2f} "
+              f"{stat['max_seconds'] * 1000:>9.1f} {megabytes:>9}", file=file)
+    # stages run concurrently, so their busy times can add up to more than this
+    print(f"wall clock: {wall_seconds:.2f}s", file=file)
+
+
+def write(path):
+    """
+    Write the summary and the collected spans as JSON in Chrome trace format, which
+    chrome://tracing and Perfetto can open.
+    """
+    with _lock:
+        events = list(_events)
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'metrics': summary()}, f)
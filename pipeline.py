@@ -0,0 +1,100 @@
+import queue
+import threading
+
+_DONE = object()
+
+
+class Stage:
+    """
+    One step of a pipeline.  `fn` is called on each item from the previous stage by
+    `workers` threads; its return value is passed to the next stage (None drops the item).
+    `queue_size` overrides the pipeline's size for the queue in front of this stage.
+    """
+
+    def __init__(self, name, fn, workers=1, queue_size=None):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+
+
+def run(items, stages, queue_size=64):
+    """
+    Run `items` through `stages`, each stage with its own worker threads and a bounded
+    queue in front of it, so all stages make progress at once.  Yields the outputs of the
+    last stage as they complete (not necessarily in input order).  If any stage raises,
+    the pipeline is stopped and the exception is re-raised here.
+    """
+    queues = [queue.Queue(stage.queue_size or queue_size) for stage in stages] + [queue.Queue(queue_size)]
+    stop = threading.Event()
+    errors = []
+
+    def put(q, item):
+        # don't block forever on a full queue if a downstream stage has failed
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def feed():
+        try:
+            for item in items:
+                if stop.is_set():
+                    break
+                put(queues[0], item)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            put(queues[0], _DONE)
+
+    def work(stage, q_in, q_out, remaining):
+        try:
+            while not stop.is_set():
+                item = q_in.get()
+                if item is _DONE:
+                    # let the other workers of this stage see the sentinel too
+                    q_in.put(_DONE)
+                    break
+                result = stage.fn(item)
+                if result is not None:
+                    put(q_out, result)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            with remaining[1]:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    put(q_out, _DONE)
+
+    threads = [threading.Thread(target=feed, name='pipeline-feed', daemon=True)]
+    for i, stage in enumerate(stages):
+        remaining = [stage.workers, threading.Lock()]
+        for n in range(stage.workers):
+            threads.append(threading.Thread(target=work, args=(stage, queues[i], queues[i + 1], remaining),
+                                            name=f'pipeline-{stage.name}-{n}', daemon=True))
+    for t in threads:
+        t.start()
+
+    try:
+        while not stop.is_set():
+            try:
+                item = queues[-1].get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                break
+            yield item
+    finally:
+        stop.set()
+        # unblock any workers still waiting on an input queue
+        for q in queues:
+            try:
+                q.put_nowait(_DONE)
+            except queue.Full:
+                pass
+    if errors:
+        raise errors[0]
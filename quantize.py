@@ -0,0 +1,147 @@
+import os
+
+import numpy as np
+
+# Compact storage for the local backend.  These settings are recorded when a collection is
+# created, and apply to that collection from then on.
+#
+# ASE_COMPACT_DIMS keeps only the first N dimensions of each embedding; text-embedding-004 is
+# trained Matryoshka-style, so the leading dimensions carry most of the signal.
+COMPACT_DIMS = int(os.environ.get('ASE_COMPACT_DIMS', 0))
+# ASE_QUANTIZATION stores each component as float32 (the default), int8 or a single sign bit
+QUANTIZATION = os.environ.get('ASE_QUANTIZATION', 'float32')
+# ASE_RERANK=1 keeps the full-precision vectors too, to rerank the candidates found in the
+# compact space; it improves recall, but stores the vectors on top of the codes
+RERANK = os.environ.get('ASE_RERANK', '0') not in ('', '0')
+# how many candidates per requested result to rerank
+RERANK_FACTOR = int(os.environ.get('ASE_RERANK_FACTOR', 4))
+
+QUANTIZATIONS = ('float32', 'int8', 'binary')
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+# rows scored at a time, to bound the temporary arrays
+_BLOCK = 65536
+
+
+def normalize(vectors):
+    """Scale float32 vectors (one per row) to unit length, so cosine similarity is a dot product."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def top_k(scores, k):
+    """Return the indices of the k highest scores, best first."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+class Codec:
+    """
+    Encodes unit vectors into a compact form: truncated to their first `dims` dimensions
+    (and rescaled to unit length), then optionally quantized.  int8 codes keep one float32
+    scale per vector; binary codes keep the sign of each component, packed 8 to a byte,
+    and are compared by Hamming distance.
+    """
+
+    def __init__(self, dimension, dims=None, quantization='float32'):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization!r}; expected one of {', '.join(QUANTIZATIONS)}")
+        self.dims = min(dims or dimension, dimension)
+        self.quantization = quantization
+        # codes are stored as an array of shape (rows,) + row_shape
+        if quantization == 'int8':
+            self.dtype = np.dtype([('scale', '<f4'), ('code', 'i1', (self.dims,))])
+            self.row_shape = ()
+        elif quantization == 'binary':
+            self.dtype = np.dtype(np.uint8)
+            self.row_shape = ((self.dims + 7) // 8,)
+        else:
+            self.dtype = np.dtype(np.float32)
+            self.row_shape = (self.dims,)
+        self.row_bytes = self.dtype.itemsize * int(np.prod(self.row_shape))
+
+    def __str__(self):
+        return f'{self.quantization} x{self.dims}'
+
+    def project(self, vectors):
+        """Truncate unit vectors to the kept dimensions and rescale them to unit length."""
+        return normalize(np.asarray(vectors)[..., :self.dims])
+
+    def encode(self, vectors):
+        vectors = self.project(vectors)
+        if self.quantization == 'int8':
+            codes = np.empty(len(vectors), dtype=self.dtype)
+            scale = np.abs(vectors).max(axis=1) / 127
+            codes['scale'] = scale
+            codes['code'] = np.rint(vectors / np.maximum(scale, np.finfo(np.float32).tiny)[:, None])
+            return codes
+        if self.quantization == 'binary':
+            return np.packbits(vectors > 0, axis=1)
+        return vectors
+
+    def decode(self, codes):
+        """Return unit vectors in the compact space approximating the encoded ones."""
+        if self.quantization == 'int8':
+            return normalize(codes['code'].astype(np.float32) * codes['scale'][:, None])
+        if self.quantization == 'binary':
+            return normalize(np.unpackbits(codes, axis=1, count=self.dims).astype(np.float32) * 2 - 1)
+        return np.asarray(codes)
+
+    def score(self, codes, query):
+        """
+        Return the approximate cosine similarity of each code to a query that was already
+        projected into the compact space.
+        """
+        scores = np.empty(len(codes), dtype=np.float32)
+        if self.quantization == 'binary':
+            bits = np.packbits(query > 0)
+        for i in range(0, len(codes), _BLOCK):
+            block = codes[i:i + _BLOCK]
+            if self.quantization == 'int8':
+                scores[i:i + _BLOCK] = (block['code'].astype(np.float32) @ query) * block['scale']
+            elif self.quantization == 'binary':
+                distance = _POPCOUNT[block ^ bits].sum(axis=1, dtype=np.float32)
+                scores[i:i + _BLOCK] = 1 - 2 * distance / self.dims
+            else:
+                scores[i:i + _BLOCK] = block @ query
+        return scores
+
+
+def evaluate(vectors, queries, limit, configs, rerank_factor=RERANK_FACTOR):
+    """
+    Measure how well compact encodings of `vectors` (unit-length rows) preserve search results.
+    Each of `queries` (row numbers of `vectors`) is searched for with its own row excluded;
+    recall is the fraction of the exact full-precision top `limit` that a search in the compact
+    space finds, with and without reranking `limit * rerank_factor` candidates at full precision.
+    `configs` is a list of (dims, quantization) pairs.  Returns one dict per config.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    truth = []
+    for row in queries:
+        scores = vectors @ vectors[row]
+        scores[row] = -np.inf
+        truth.append(set(top_k(scores, limit)))
+
+    results = []
+    for dims, quantization in configs:
+        codec = Codec(vectors.shape[1], dims, quantization)
+        codes = codec.encode(vectors)
+        found = reranked = 0
+        for row, expected in zip(queries, truth):
+            scores = codec.score(codes, codec.project(vectors[row]))
+            scores[row] = -np.inf
+            found += len(expected & set(top_k(scores, limit)))
+            shortlist = top_k(scores, limit * rerank_factor)
+            shortlist = shortlist[np.isfinite(scores[shortlist])]
+            reranked += len(expected & set(shortlist[top_k(vectors[shortlist] @ vectors[row], limit)]))
+        total = max(1, sum(len(expected) for expected in truth))
+        full_bytes = vectors.shape[1] * 4
+        # reranking needs the full-precision vectors as well as the codes
+        results.append({'config': str(codec), 'bytes': codec.row_bytes,
+                        'compression': full_bytes / codec.row_bytes, 'recall': found / total,
+                        'reranked_bytes': codec.row_bytes + full_bytes, 'reranked_recall': reranked / total})
+    return results
@@ -0,0 +1,189 @@
+import email.utils
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import metrics
+from util import ase_home
+
+# Set ASE_RATELIMIT_SHARED=1 to share quotas between all ase processes on this machine
+# (for example, several `ase index` runs against the same API key).
+SHARED = os.environ.get('ASE_RATELIMIT_SHARED', '') not in ('', '0')
+
+MAX_RETRIES = 8
+MAX_BACKOFF = 60.0
+
+
+def is_throttled(e):
+    """True if the exception means the server throttled or was too busy for the request."""
+    # anthropic.APIStatusError has status_code; google.api_core exceptions have code
+    status = getattr(e, 'status_code', None) or getattr(e, 'code', None)
+    return status in (429, 503, 529)
+
+
+def _retry_after(e):
+    response = getattr(e, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if headers is None:
+        return None
+    value = headers.get('retry-after')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _parse_reset(value, now):
+    """Parse a rate limit reset header, either seconds from now or an RFC 3339 / HTTP date."""
+    try:
+        return now + float(value)
+    except ValueError:
+        pass
+    try:
+        from datetime import datetime
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        pass
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """
+    Schedules calls to one API under a requests-per-minute and an optional tokens-per-minute
+    quota, using two token buckets.
+
+    `call` waits for capacity, then makes the call.  When the server throttles it, `call`
+    retries with jittered exponential backoff (or the server's retry-after) and pauses
+    everyone sharing the limiter until then.  It also halves the effective rate, which
+    then recovers gradually as calls succeed.  Rate limit headers reported by the server
+    can be fed to `observe_headers`.
+
+    With shared=True the bucket state lives in SQLite under ASE_HOME, so concurrent
+    processes draw from the same quota.
+    """
+
+    def __init__(self, name, requests_per_minute, tokens_per_minute=None, shared=SHARED):
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.shared = shared
+        self.wait_time = 0.0  # total seconds spent waiting for capacity, for reporting
+        self.retries = 0
+        self._factor = 1.0  # adaptive fraction of the nominal rates
+        self._lock = threading.Lock()
+        self._conn = None
+        self._state = None
+
+    # bucket state: requests available, tokens available, last refill time, paused until
+    def _load(self, now):
+        if not self.shared:
+            if self._state is None:
+                self._state = [self.requests_per_minute, self.tokens_per_minute or 0, now, 0.0]
+            return self._state
+        if self._conn is None:
+            self._conn = sqlite3.connect(os.path.join(ase_home(), 'ratelimit.sqlite'), timeout=60,
+                                         isolation_level=None, check_same_thread=False)
+            self._conn.execute('CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, requests REAL, '
+                               'tokens REAL, updated REAL, paused_until REAL)')
+        self._conn.execute('BEGIN IMMEDIATE')
+        row = self._conn.execute('SELECT requests, tokens, updated, paused_until FROM buckets WHERE name = ?',
+                                 (self.name,)).fetchone()
+        return list(row) if row else [self.requests_per_minute, self.tokens_per_minute or 0, now, 0.0]
+
+    def _save(self, state):
+        if self.shared:
+            self._conn.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?)', [self.name] + state)
+            self._conn.execute('COMMIT')
+
+    def _reserve(self, tokens):
+        """Take one request and `tokens` tokens if available; otherwise return the seconds to wait."""
+        with self._lock:
+            now = time.time()
+            state = self._load(now)
+            try:
+                rpm = self.requests_per_minute * self._factor
+                tpm = (self.tokens_per_minute or 0) * self._factor
+                elapsed = max(0.0, now - state[2])
+                state[0] = min(self.requests_per_minute, state[0] + elapsed * rpm / 60)
+                if self.tokens_per_minute:
+                    state[1] = min(self.tokens_per_minute, state[1] + elapsed * tpm / 60)
+                    # a request bigger than the whole budget waits for a full bucket, then goes
+                    tokens = min(tokens, self.tokens_per_minute)
+                state[2] = now
+                wait = max(0.0, state[3] - now)
+                if not wait:
+                    wait = max(0.0, (1 - state[0]) * 60 / rpm)
+                    if self.tokens_per_minute:
+                        wait = max(wait, (tokens - state[1]) * 60 / tpm)
+                if not wait:
+                    state[0] -= 1
+                    if self.tokens_per_minute:
+                        state[1] -= tokens
+                return wait
+            finally:
+                self._save(state)
+
+    def acquire(self, tokens=0):
+        """Block until one request with `tokens` tokens fits in the quota."""
+        while True:
+            wait = self._reserve(tokens)
+            if not wait:
+                return
+            self.wait_time += wait
+            metrics.record(f'ratelimit.{self.name}.wait', wait)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stop everyone using this limiter from sending requests for the next `seconds`."""
+        with self._lock:
+            now = time.time()
+            state = self._load(now)
+            state[3] = max(state[3], now + seconds)
+            self._save(state)
+
+    def observe_headers(self, headers):
+        """
+        Adapt to the rate limit headers of a response: if the server reports that the
+        requests or tokens remaining in its window are exhausted, pause until it resets.
+        """
+        now = time.time()
+        for kind in ('requests', 'tokens'):
+            for remaining_name, reset_name in ((f'anthropic-ratelimit-{kind}-remaining', f'anthropic-ratelimit-{kind}-reset'),
+                                               (f'x-ratelimit-remaining-{kind}', f'x-ratelimit-reset-{kind}')):
+                remaining, reset = headers.get(remaining_name), headers.get(reset_name)
+                if remaining is None or reset is None:
+                    continue
+                try:
+                    exhausted = float(remaining) < 1
+                except ValueError:
+                    continue
+                reset_at = _parse_reset(reset, now)
+                if exhausted and reset_at and reset_at > now:
+                    self.pause(reset_at - now)
+
+    def call(self, fn, *args, tokens=0, **kwargs):
+        """Call fn(*args, **kwargs) within the quota, retrying when the server throttles it."""
+        for attempt in range(MAX_RETRIES + 1):
+            self.acquire(tokens)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if not is_throttled(e) or attempt == MAX_RETRIES:
+                    raise
+                self.retries += 1
+                metrics.record(f'ratelimit.{self.name}.retries')
+                delay = _retry_after(e)
+                if delay is None:
+                    delay = min(MAX_BACKOFF, 2 ** attempt) * random.uniform(0.5, 1.5)
+                with self._lock:
+                    self._factor = max(0.1, self._factor / 2)
+                self.pause(delay)
+                continue
+            with self._lock:
+                self._factor = min(1.0, self._factor + 0.05)
+            return result
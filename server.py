@@ -0,0 +1,148 @@
+import json
+import os
+import socketserver
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+
+# how many query embeddings to keep in memory
+QUERY_CACHE_SIZE = 4096
+# concurrent vector lookups for a batch of queries
+SEARCH_WORKERS = 8
+
+
+class QueryCache:
+    """A thread-safe LRU cache of query embeddings."""
+
+    def __init__(self, size=QUERY_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, query):
+        with self._lock:
+            embedding = self._entries.get(query)
+            if embedding is not None:
+                self._entries.move_to_end(query)
+            return embedding
+
+    def put(self, query, embedding):
+        with self._lock:
+            self._entries[query] = embedding
+            self._entries.move_to_end(query)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+class Daemon:
+    """
+    Keeps the encoder and one open store per collection warm across requests, so a
+    search costs only the (cached) query embedding and the vector lookup.  Stores are
+    opened with the backend named in the request, since the client's ASE_DB may differ
+    from the daemon's.
+    """
+
+    def __init__(self):
+        self._stores = {}
+        self._paths = {}
+        self._lock = threading.Lock()
+        self.queries = QueryCache()
+        self._executor = ThreadPoolExecutor(SEARCH_WORKERS)
+        # import the encoder (and its API client) up front rather than on the first query
+        import encoder
+        encoder.gemini()
+        self._encode = encoder.encode
+
+    def store(self, collection, backend=None):
+        key = (backend or db.backend_name(), collection)
+        with self._lock:
+            if key not in self._stores:
+                self._stores[key] = db.open_store(collection, key[0])
+                self._paths[key] = {}
+            return self._stores[key], self._paths[key]
+
+    def embed_query(self, query):
+        return self.embed_queries([query])[0]
+
+    def embed_queries(self, queries):
+        """Embed the queries, with one encode call for all of those not already cached."""
+        embeddings = [self.queries.get(query) for query in queries]
+        missing = list(dict.fromkeys(query for query, embedding in zip(queries, embeddings) if embedding is None))
+        if missing:
+            fresh = dict(zip(missing, self._encode(missing)))
+            for query, embedding in fresh.items():
+                self.queries.put(query, embedding)
+            embeddings = [fresh[query] if embedding is None else embedding
+                          for query, embedding in zip(queries, embeddings)]
+        return embeddings
+
+    def search(self, collection, query, limit, nprobe=None, backend=None):
+        return self._lookup(collection, self.embed_query(query), limit, nprobe, backend)
+
+    def search_batch(self, collection, queries, limit, nprobe=None, backend=None):
+        embeddings = self.embed_queries(queries)
+        return list(self._executor.map(lambda embedding: self._lookup(collection, embedding, limit, nprobe, backend),
+                                       embeddings))
+
+    def search_collections(self, collections, query, limit, nprobe=None, backend=None):
+        results = db.search_collections(collections, self.embed_query(query), limit, nprobe,
+                                        lambda collection: self.store(collection, backend))
+        return [{'path': result['path'], 'chunk': result['chunk'], 'file_id': result['file_id'],
+                 '$similarity': result.get('$similarity'), 'collection': result['collection']} for result in results]
+
+    def _lookup(self, collection, embedding, limit, nprobe, backend):
+        store, paths = self.store(collection, backend)
+        results = db.with_paths(store, list(store.search(embedding, limit, nprobe)), paths)
+        return [{'path': result['path'], 'chunk': result['chunk'], 'file_id': result['file_id'],
+                 '$similarity': result.get('$similarity')} for result in results]
+
+    def handle(self, message):
+        if message.get('command') == 'search':
+            return {'results': self.search(message['collection'], message['query'], message['limit'],
+                                           message.get('nprobe'), message.get('backend'))}
+        if message.get('command') == 'search_batch':
+            return {'results': self.search_batch(message['collection'], message['queries'], message['limit'],
+                                                 message.get('nprobe'), message.get('backend'))}
+        if message.get('command') == 'search_collections':
+            return {'results': self.search_collections(message['collections'], message['query'], message['limit'],
+                                                       message.get('nprobe'), message.get('backend'))}
+        if message.get('command') == 'ping':
+            return {'pong': os.getpid()}
+        raise ValueError(f"unknown command {message.get('command')!r}")
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.daemon.handle(json.loads(line))
+            except Exception as e:
+                response = {'error': f'{type(e).__name__}: {e}'}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path):
+    """Serve requests from `client` on the Unix socket at `path` until interrupted."""
+    import client
+    if client.request({'command': 'ping'}, path) is not None:
+        raise RuntimeError(f'ase serve is already running on {path}')
+    if os.path.exists(path):
+        os.unlink(path)
+    daemon = Daemon()
+    with _Server(path, _Handler) as server:
+        os.chmod(path, 0o600)
+        server.daemon = daemon
+        print(f'ase serving on {path}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(path)
@@ -0,0 +1,59 @@
+class Store:
+    """
+    Interface implemented by the storage backends behind db.py.  A store holds the
+    files and embeddings of a single collection.
+
+    File documents are dicts with '_id', 'path' and 'hash'; chunk results are dicts
+    with 'file_id', 'path' and 'chunk'.  Every stored chunk also records the sha256 of its text,
+    so a changed file can be re-indexed by replacing only the chunks that changed.
+    """
+
+    def hashes_cursor(self):
+        """Return all documents in the files collection."""
+        raise NotImplementedError
+
+    def file_by_id(self, file_id):
+        """Return the file document with the given id."""
+        raise NotImplementedError
+
+    def files_by_ids(self, file_ids):
+        """Return the file documents with the given ids, in a single round trip."""
+        raise NotImplementedError
+
+    def delete(self, file_id):
+        """Delete the file and embeddings documents associated with the given file"""
+        raise NotImplementedError
+
+    def delete_many(self, file_ids):
+        """Delete the given files and their embeddings; backends override this to batch the deletes."""
+        for file_id in file_ids:
+            self.delete(file_id)
+
+    def insert(self, file_id, full_path, file_hash, chunks, encoded_chunks):
+        """
+        Insert the file and embeddings documents associated with the given file.
+        If file_id is None, a new id is generated.  Returns the file's id.
+        """
+        raise NotImplementedError
+
+    def update(self, file_id, full_path, file_hash, chunks, encoded_chunks, removed_chunk_ids):
+        """
+        Update an existing file in place: delete the chunks with the given ids, add the
+        given new chunks, and record the file's new hash.
+        """
+        raise NotImplementedError
+
+    def get_chunk_hashes(self, file_id):
+        """Return a dict mapping chunk hash to the ids of the file's chunks with that hash."""
+        raise NotImplementedError
+
+    def search(self, query_embedding, limit, nprobe=None):
+        """
+        Return the top `limit` chunks that are most similar to the given query embedding.
+        `nprobe` tunes recall against latency for backends with an approximate index.
+        """
+        raise NotImplementedError
+
+    def get_chunks_by_file_id(self, file_id):
+        """Return all chunks associated with the given file_id."""
+        raise NotImplementedError
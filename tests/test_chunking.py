@@ -0,0 +1,31 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from chunking import extract_chunks, extract_sized_chunks
+
+
+def small_functions(n, edited=None):
+    return ''.join(f'def f{i}(x):\n    return x + {i}{"  # edited: now with a longer comment" if i == edited else ""}\n\n\n' for i in range(n))
+
+
+def test_small_definitions_are_merged():
+    code = small_functions(300)
+    assert len(extract_sized_chunks(code, 'python')) < len(extract_chunks(code, 'python')) / 4
+
+
+def test_editing_one_small_definition_keeps_the_other_merged_chunks():
+    before = extract_sized_chunks(small_functions(300), 'python')
+    after = extract_sized_chunks(small_functions(300, edited=150), 'python')
+    changed = [chunk for chunk in after if chunk not in before]
+    # the edited definition's group, and at most the one next to it if the edit moved an anchor
+    assert 1 <= len(changed) <= 2
+    assert any('def f150(' in chunk for chunk in changed)
+    assert len([chunk for chunk in before if chunk not in after]) <= 2
+
+
+def test_deeply_nested_code_is_split_without_recursion():
+    code = 'x = ' + '[\n' * 3000 + ']' * 3000 + '\n'
+    chunks = extract_sized_chunks(code, 'python')
+    assert chunks and chunks[0].startswith('x = [')
@@ -0,0 +1,49 @@
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import ase
+import db
+import encoder
+
+LATENCY = 0.2
+
+
+def test_embed_requests_are_full_and_concurrent(tmp_path, monkeypatch):
+    """One-chunk files are packed into full embedding requests, embed_workers of them at a time."""
+    monkeypatch.setenv('ASE_HOME', str(tmp_path / 'home'))
+    monkeypatch.setenv('ASE_DB', 'local')
+    monkeypatch.setenv('ASE_EMBEDDING_CACHE_MB', '0')
+    monkeypatch.setattr(encoder.limiter, 'acquire', lambda tokens=0: None)
+    batch_sizes = []
+    inflight = [0, 0]  # current, max
+    lock = threading.Lock()
+
+    def fake_embed(inputs):
+        with lock:
+            batch_sizes.append(len(inputs))
+            inflight[0] += 1
+            inflight[1] = max(inflight[1], inflight[0])
+        time.sleep(LATENCY)
+        with lock:
+            inflight[0] -= 1
+        return [[1.0, float(len(text))] + [0.0] * 14 for text in inputs]
+    monkeypatch.setattr(encoder, '_embed', fake_embed)
+
+    corpus = tmp_path / 'corpus'
+    corpus.mkdir()
+    n_files = 1000
+    for i in range(n_files):
+        (corpus / f'f{i}.py').write_text(f'def f{i}():\n    return {i}\n')
+
+    monkeypatch.setattr(sys, 'argv', ['ase.py', 'index', str(corpus), '--collection', 'pipeline', '--embed-workers', '4'])
+    args = ase.parse_arguments()
+    db.init(args.collection)
+    assert ase.index(args) == n_files
+
+    assert sum(batch_sizes) == n_files
+    assert sum(size == encoder.MAX_BATCH_INPUTS for size in batch_sizes) >= n_files // encoder.MAX_BATCH_INPUTS - 1
+    assert inflight[1] == args.embed_workers
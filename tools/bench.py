@@ -0,0 +1,290 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from pathlib import Path
+
+# Add the project directory to Python path
+project_root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(project_root))
+
+# Everything runs offline: a throwaway ASE_HOME and the local backend, and quotas high enough
+# that the rate limiters never throttle the stand-in services.  These must be set before the
+# modules that read them are imported.
+_home = tempfile.TemporaryDirectory(prefix='ase-bench-')
+os.environ['ASE_HOME'] = _home.name
+os.environ['ASE_DB'] = 'local'
+os.environ['ASE_EMBED_RPM'] = os.environ['ASE_CONTEXT_RPM'] = str(10 ** 9)
+os.environ.pop('ASE_EMBED_TPM', None)
+os.environ.pop('ASE_CONTEXT_TPM', None)
+
+import numpy as np
+
+import ase
+import chunking
+import db
+import encoder
+
+TEMPLATES = {
+    'python': ('class Service{n}:\n'
+               '    """Handles {word} requests for tenant {n}."""\n'
+               '    def handle_{word}(self, request):\n'
+               '        if request.size > {n}:\n'
+               '            return [self.{word}_item(i) for i in range(request.size)]\n'
+               '        return None\n\n'
+               'def {word}_helper_{n}(value):\n'
+               '    return value * {n}\n\n'),
+    'java': ('class Service{n} {{\n'
+             '    private int {word}Count = {n};\n'
+             '    public int handle{n}(int request) {{\n'
+             '        if (request > {n}) {{ return request * {word}Count; }}\n'
+             '        return 0;\n'
+             '    }}\n'
+             '}}\n\n'),
+    'javascript': ('function {word}Handler{n}(request) {{\n'
+                   '  if (request.size > {n}) {{\n'
+                   '    return request.items.map(item => item.{word});\n'
+                   '  }}\n'
+                   '  return null;\n'
+                   '}}\n\n'),
+    'go': ('func Handle{n}(request *{word}Request) int {{\n'
+           '\tif request.Size > {n} {{\n'
+           '\t\treturn request.Size * {n}\n'
+           '\t}}\n'
+           '\treturn 0\n'
+           '}}\n\n'),
+}
+EXTENSIONS = {'python': '.py', 'java': '.java', 'javascript': '.js', 'go': '.go'}
+WORDS = ['cache', 'index', 'query', 'session', 'billing', 'upload', 'auth', 'render', 'parse', 'schedule']
+STAGES = ['walk', 'hash', 'chunk', 'context', 'embed', 'insert']
+
+
+def generate_corpus(root, n_files, languages, definitions, seed):
+    """Write n_files source files spread over nested directories; returns the total bytes written."""
+    rng = random.Random(seed)
+    total = 0
+    for i in range(n_files):
+        language = languages[i % len(languages)]
+        directory = os.path.join(root, f'pkg{i % 10}', f'mod{i % 7}')
+        os.makedirs(directory, exist_ok=True)
+        n_definitions = rng.randint(max(1, definitions // 2), definitions * 2)
+        code = ''.join(TEMPLATES[language].format(n=i * 1000 + d, word=rng.choice(WORDS))
+                       for d in range(n_definitions))
+        with open(os.path.join(directory, f'file{i}{EXTENSIONS[language]}'), 'w', encoding='utf-8') as f:
+            f.write(code)
+        total += len(code.encode('utf-8'))
+    return total
+
+
+class Timings:
+    """Latency samples by stage, recorded from any thread."""
+
+    def __init__(self):
+        self.samples = {}
+        self.chunks = 0
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def wrap(self, stage, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return timed
+
+    def wrap_iter(self, stage, fn):
+        """Wrap a generator function, timing the production of each item."""
+        def timed(*args, **kwargs):
+            items = iter(fn(*args, **kwargs))
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                self.record(stage, time.perf_counter() - start)
+                yield item
+        return timed
+
+    def summary(self):
+        report = {}
+        for stage, samples in self.samples.items():
+            ms = np.array(samples) * 1000
+            report[stage] = {'count': len(samples), 'total_s': float(ms.sum() / 1000),
+                             'p50_ms': float(np.percentile(ms, 50)), 'p95_ms': float(np.percentile(ms, 95)),
+                             'p99_ms': float(np.percentile(ms, 99))}
+        return report
+
+
+def fake_embed(dimension, latency):
+    """A deterministic stand-in for the embedding API: hashed bag-of-words vectors."""
+    def embed(inputs):
+        time.sleep(latency)
+        embeddings = []
+        for text in inputs:
+            vector = np.zeros(dimension, dtype=np.float32)
+            for word in text.split():
+                h = zlib.crc32(word.encode('utf-8'))
+                vector[h % dimension] += 1 if h & 0x80000000 else -1
+            vector[0] += 0.01
+            embeddings.append(vector.tolist())
+        return embeddings
+    return embed
+
+
+def fake_context(latency):
+    """A deterministic stand-in for the LLM that writes chunk contexts."""
+    def get_chunk_context(full_code, chunk):
+        time.sleep(latency)
+        return f'Context: chunk {zlib.crc32(chunk.encode("utf-8")):08x} of a {len(full_code)}-character file.'
+    return get_chunk_context
+
+
+class SlowStore:
+    """Wraps a store, adding a fixed latency to every call, like a round trip to a database service."""
+
+    def __init__(self, store, latency):
+        self._store = store
+        self._latency = latency
+
+    def __getattr__(self, name):
+        method = getattr(self._store, name)
+
+        def slow(*args, **kwargs):
+            time.sleep(self._latency)
+            return method(*args, **kwargs)
+        return slow
+
+
+def install_stand_ins(args, timings):
+    encoder._embed = timings.wrap('embed_request', fake_embed(args.dimension, args.embed_latency / 1000))
+    chunking.get_chunk_context = timings.wrap('context', fake_context(args.context_latency / 1000))
+    open_store = db.open_store
+    db.open_store = lambda name, backend=None: SlowStore(open_store(name, backend), args.db_latency / 1000)
+    # per-stage timings of the index pipeline
+    ase.get_indexable_files = timings.wrap_iter('walk', ase.get_indexable_files)
+    ase.hexdigest = timings.wrap('hash', ase.hexdigest)
+    chunking.chunkify_file = timings.wrap('chunk', chunking.chunkify_file)
+    batcher_submit = encoder.Batcher.submit
+
+    def submit_chunks(batcher, chunks):
+        # the embed stage is the time from submitting a file's chunks to having their embeddings
+        with timings._lock:
+            timings.chunks += len(chunks)
+        start = time.perf_counter()
+        future = batcher_submit(batcher, chunks)
+        future.add_done_callback(lambda _: timings.record('embed', time.perf_counter() - start))
+        return future
+    encoder.Batcher.submit = submit_chunks
+    db.insert = timings.wrap('insert', db.insert)
+    db.update = timings.wrap('insert', db.update)
+    db.search = timings.wrap('search', db.search)
+
+
+def print_stages(stages):
+    print(f"{'stage':<14} {'count':>7} {'total s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for stage in sorted(stages, key=lambda s: STAGES.index(s) if s in STAGES else len(STAGES)):
+        t = stages[stage]
+        print(f"{stage:<14} {t['count']:>7} {t['total_s']:>9.2f} {t['p50_ms']:>9.2f} {t['p95_ms']:>9.2f} {t['p99_ms']:>9.2f}")
+
+
+def parse_ase_args(argv):
+    sys.argv = ['ase.py'] + argv
+    return ase.parse_arguments()
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=project_root, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ase index and ase search offline, against a synthetic "
+                                                 "corpus and local stand-ins for the embedding, context and database services.")
+    parser.add_argument("--files", type=int, default=500, help="Number of files in the corpus (default: %(default)s)")
+    parser.add_argument("--definitions", type=int, default=10, help="Average definitions per file (default: %(default)s)")
+    parser.add_argument("--languages", default=','.join(TEMPLATES), help="Comma-separated languages (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="Corpus random seed (default: %(default)s)")
+    parser.add_argument("--dimension", type=int, default=768, help="Embedding dimension (default: %(default)s)")
+    parser.add_argument("--embed-latency", type=float, default=100, metavar='MS', help="Latency of each embedding request (default: %(default)s)")
+    parser.add_argument("--context-latency", type=float, default=200, metavar='MS', help="Latency of each context request (default: %(default)s)")
+    parser.add_argument("--db-latency", type=float, default=10, metavar='MS', help="Latency of each database call (default: %(default)s)")
+    parser.add_argument("--contextual", action='store_true', help="Generate chunk contexts (ASE_CONTEXT=contextual)")
+    parser.add_argument("--queries", type=int, default=50, help="Number of searches to time (default: %(default)s)")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+    if args.contextual:
+        os.environ['ASE_CONTEXT'] = 'contextual'
+
+    timings = Timings()
+    install_stand_ins(args, timings)
+    corpus = os.path.join(_home.name, 'corpus')
+    languages = args.languages.split(',')
+    corpus_bytes = generate_corpus(corpus, args.files, languages, args.definitions, args.seed)
+
+    index_args = parse_ase_args(['index', corpus, '--collection', 'bench'])
+    db.init(index_args.collection)
+    start = time.perf_counter()
+    ase.index(index_args)
+    index_seconds = time.perf_counter() - start
+    n_chunks = timings.chunks
+    index_stages = timings.summary()
+
+    # time searches separately from indexing
+    timings.samples.clear()
+    rng = random.Random(args.seed)
+    latencies = []
+    for i in range(args.queries):
+        query = f'{rng.choice(WORDS)} handler for request {rng.randint(0, args.files * 1000)}'
+        search_args = parse_ase_args(['search', corpus, query, '--collection', 'bench', '--no-server'])
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            ase.search(search_args)
+        latencies.append(time.perf_counter() - start)
+    search_ms = np.array(latencies) * 1000
+
+    results = {
+        'commit': git_commit(),
+        'parameters': vars(args),
+        'index': {'files': args.files, 'chunks': n_chunks, 'bytes': corpus_bytes, 'seconds': index_seconds,
+                  'files_per_s': args.files / index_seconds, 'chunks_per_s': n_chunks / index_seconds,
+                  'stages': index_stages},
+        'search': {'queries': args.queries,
+                   'p50_ms': float(np.percentile(search_ms, 50)) if len(search_ms) else None,
+                   'p95_ms': float(np.percentile(search_ms, 95)) if len(search_ms) else None,
+                   'p99_ms': float(np.percentile(search_ms, 99)) if len(search_ms) else None,
+                   'stages': timings.summary()},
+    }
+
+    index_result, search_result = results['index'], results['search']
+    print(f"\nindex: {args.files} files, {n_chunks} chunks, {corpus_bytes / 1024:.0f} KB in {index_seconds:.2f}s "
+          f"({index_result['files_per_s']:.1f} files/s, {index_result['chunks_per_s']:.1f} chunks/s)")
+    print_stages(index_result['stages'])
+    if args.queries:
+        print(f"\nsearch: {args.queries} queries, p50 {search_result['p50_ms']:.1f} ms, "
+              f"p95 {search_result['p95_ms']:.1f} ms, p99 {search_result['p99_ms']:.1f} ms")
+        print_stages(search_result['stages'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
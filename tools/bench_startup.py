@@ -0,0 +1,71 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+project_root = Path(__file__).resolve().parent.parent
+
+# Each case is a command line run in a fresh interpreter; together they cover what every
+# command pays (importing ase), a complete search that needs no network, and the heavy
+# modules that only indexing should load.
+CASES = {
+    'import ase': [sys.executable, '-c', 'import ase'],
+    'ase search --mode lexical': [sys.executable, 'ase.py', 'search', '.', 'startup', '--mode', 'lexical'],
+    'import chunking': [sys.executable, '-c', 'import chunking'],
+    'import encoder': [sys.executable, '-c', 'import encoder'],
+}
+
+
+def time_command(command, env, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=project_root, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def slowest_imports(env, n):
+    """Return the n slowest modules imported by `import ase`, with their cumulative import time."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ase'], cwd=project_root,
+                            env=env, capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imports.append((int(cumulative) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:n]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time ase's startup, to catch imports and initialization creeping back in.")
+    parser.add_argument("--repeat", type=int, default=5, help="Take the median of this many runs (default: %(default)s)")
+    parser.add_argument("--max-ms", type=float, help="Exit with an error if `ase search --mode lexical` takes longer than this")
+    parser.add_argument("--imports", type=int, default=10, help="Show this many of the slowest imports of ase (default: %(default)s)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='ase-startup-') as home:
+        env = dict(os.environ, ASE_HOME=home, ASE_DB='local')
+        results = {}
+        for name, command in CASES.items():
+            results[name] = time_command(command, env, args.repeat)
+            print(f"{name:<28} {results[name]:>8.0f} ms")
+
+        if args.imports:
+            print("\nslowest imports of ase (cumulative):")
+            for ms, module in slowest_imports(env, args.imports):
+                print(f"{module:<40} {ms:>8.1f} ms")
+
+    if args.max_ms is not None and results['ase search --mode lexical'] > args.max_ms:
+        print(f"\nase search startup exceeds {args.max_ms:g} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,38 +2,35 @@ import sys
 import argparse
 from pathlib import Path
 
-# Add the project root directory to Python path
-project_root = Path(__file__).resolve().parent.parent.parent
+# Add the project directory to Python path
+project_root = Path(__file__).resolve().parent.parent
 sys.path.insert(0, str(project_root))
 
-from ase.util import infer_language
-from ase.chunking import chunkify_code
+from chunking import chunkify_files, expand_paths
 
 def main():
-    parser = argparse.ArgumentParser(description="Chunk a single file.")
-    parser.add_argument("file_path", help="Path to the file to be chunked")
+    parser = argparse.ArgumentParser(description="Chunk files, or every indexable file in a directory.")
+    parser.add_argument("paths", nargs='+', help="Files or directories to be chunked")
+    parser.add_argument("--workers", type=int, help="Number of worker processes (default: number of CPUs)")
     args = parser.parse_args()
 
-    file_path = Path(args.file_path)
-    
-    if not file_path.is_file():
-        print(f"Error: {file_path} is not a valid file.")
-        sys.exit(1)
+    file_paths = []
+    for path in expand_paths(args.paths):
+        if not Path(path).is_file():
+            print(f"Error: {path} is not a valid file.")
+            sys.exit(1)
+        file_paths.append(path)
 
-    with open(file_path, 'r') as file:
-        code = file.read()
-    
-    language = infer_language(file_path)
-    chunks = chunkify_code(code, language)
-    
-    print(f"File: {file_path} ({len(code)} characters in {language})")
-    for i, chunk in enumerate(chunks):
-        if not chunk.strip():
-            raise ValueError(f"Empty chunk found at index {i}")
-        print(f"Chunk {i + 1}:")
-        print(chunk)
-        print('-' * 80)
-    print()
+    for file_path, chunks in chunkify_files(file_paths, args.workers):
+        code = Path(file_path).read_text(encoding='utf-8')
+        print(f"File: {file_path} ({len(code)} characters)")
+        for i, chunk in enumerate(chunks):
+            if not chunk.strip():
+                raise ValueError(f"Empty chunk found in {file_path} at index {i}")
+            print(f"Chunk {i + 1}:")
+            print(chunk)
+            print('-' * 80)
+        print()
 
 if __name__ == "__main__":
     main()
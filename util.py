@@ -1,33 +1,154 @@
 import hashlib
 import os
 import sys
+import time
+
+import metrics
+from ignore import DEFAULT_IGNORES, IGNORE_FILES, IgnoreRules, is_ignored
 
 
 def hexdigest(full_path):
+    start = time.perf_counter()
     hash = hashlib.sha256()
-    hash.update(open(full_path, 'rb').read())
+    data = open(full_path, 'rb').read()
+    hash.update(data)
+    metrics.record('hash', time.perf_counter() - start, nbytes=len(data), start=start)
     return hash.hexdigest()
 
 
-def get_indexable_files(root, languages=None):
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for budgeting API requests; ~4 characters per token for code."""
+    return len(text) // 4 + 1
+
+
+# Files larger than this are almost always generated or data, not code worth embedding
+MAX_FILE_BYTES = int(os.environ.get('ASE_MAX_FILE_BYTES', 1024 * 1024))
+
+
+def get_indexable_files(root, languages=None, max_file_bytes=MAX_FILE_BYTES, skip_binary=True, workers=1):
     """
-    Returns a list of files that can be indexed based on their language.
+    Yields the files under root that can be indexed based on their language, as they are found.
+
+    Honors .gitignore and .aseignore files at every level as well as a built-in list of
+    directories that are never worth indexing (.git, node_modules, virtualenvs, build output),
+    and skips files larger than max_file_bytes and files that look binary.  With workers > 1,
+    directories are scanned by that many threads in parallel.
 
     :param root: Path to the directory containing code files
     :param languages: Optional list of languages to filter by
-    :return: List of full file paths that can be indexed
+    :return: Iterator of full file paths that can be indexed
     """
     real_root = os.path.realpath(root)
-    indexable_files = []
 
-    for root, _, files in os.walk(real_root):
-        for file in files:
-            full_path = os.path.join(root, file)
-            language = infer_language(full_path)
-            if language and (not languages or language in languages):
-                indexable_files.append(full_path)
+    def scan(directory, rules):
+        """Return the indexable files and the (subdirectory, rules) pairs to scan next."""
+        with metrics.span('walk'):
+            files, subdirs = _scan(directory, rules)
+        metrics.record('walk.files', n=len(files))
+        return files, subdirs
+
+    def _scan(directory, rules):
+        rules = rules + _load_ignore_files(directory)
+        files, subdirs = [], []
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return files, subdirs
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if not is_ignored(rules, entry.path, True):
+                        subdirs.append((entry.path, rules))
+                elif entry.is_file():
+                    language = infer_language(entry.name)
+                    if (language and (not languages or language in languages)
+                            and not is_ignored(rules, entry.path, False)
+                            and entry.stat().st_size <= max_file_bytes
+                            and not (skip_binary and is_binary(entry.path))):
+                        files.append(entry.path)
+            except OSError:
+                continue
+        return files, subdirs
+
+    pending = [(real_root, [IgnoreRules(real_root, DEFAULT_IGNORES)])]
+    if workers <= 1:
+        while pending:
+            files, subdirs = scan(*pending.pop())
+            yield from files
+            pending.extend(reversed(subdirs))
+        return
+
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+    with ThreadPoolExecutor(workers, thread_name_prefix='walk') as pool:
+        futures = {pool.submit(scan, *pending.pop())}
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                yield from files
+                futures.update(pool.submit(scan, *subdir) for subdir in subdirs)
 
-    return indexable_files
+
+def _load_ignore_files(directory):
+    return [rules for rules in (IgnoreRules.load(directory, name) for name in IGNORE_FILES) if rules]
+
+
+class IndexableFilter:
+    """
+    Decides whether single paths under root would be indexed by get_indexable_files with
+    the same settings, for callers that learn about paths one at a time (ase index --watch).
+    Ignore files are read once per directory; call `reset` after one of them changes.
+    """
+
+    def __init__(self, root, languages=None, max_file_bytes=MAX_FILE_BYTES, skip_binary=True):
+        self.root = os.path.realpath(root)
+        self.languages = languages
+        self.max_file_bytes = max_file_bytes
+        self.skip_binary = skip_binary
+        self.reset()
+
+    def reset(self):
+        # directory -> the ignore rules that apply to its entries, or None if it isn't scanned
+        self._rules = {self.root: [IgnoreRules(self.root, DEFAULT_IGNORES)] + _load_ignore_files(self.root)}
+
+    def _rules_in(self, directory):
+        if directory not in self._rules:
+            if not directory.startswith(self.root + os.sep):
+                return None
+            rules = self._rules_in(os.path.dirname(directory))
+            if rules is not None and not is_ignored(rules, directory, True):
+                rules = rules + _load_ignore_files(directory)
+            else:
+                rules = None
+            self._rules[directory] = rules
+        return self._rules[directory]
+
+    def directory(self, path):
+        """True if the directory is scanned for files to index."""
+        return path == self.root or self._rules_in(path) is not None
+
+    def file(self, path):
+        """True if the file exists and would be indexed."""
+        language = infer_language(path)
+        if not language or (self.languages and language not in self.languages):
+            return False
+        rules = self._rules_in(os.path.dirname(path))
+        try:
+            return (rules is not None and not is_ignored(rules, path, False)
+                    and os.path.isfile(path) and os.path.getsize(path) <= self.max_file_bytes
+                    and not (self.skip_binary and is_binary(path)))
+        except OSError:
+            return False
+
+
+def is_binary(full_path):
+    """Files with a NUL byte near the start are treated as binary, as git does."""
+    with open(full_path, 'rb') as f:
+        return b'\0' in f.read(8000)
 
 
 LANGUAGES_BY_EXTENSION = {
@@ -66,3 +187,13 @@ def validate_language(language):
         print(f"Recognized languages: {', '.join(LANGUAGES_BY_EXTENSION.values())}")
         print("Note: Language names are case-sensitive and should be lowercase.")
         sys.exit(1)
+
+
+def ase_home():
+    """
+    Returns the directory where ase keeps local state (caches, local indexes).
+    Defaults to ~/.ase; override with ASE_HOME.
+    """
+    path = os.environ.get('ASE_HOME') or os.path.join(os.path.expanduser('~'), '.ase')
+    os.makedirs(path, exist_ok=True)
+    return path
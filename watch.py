@@ -0,0 +1,193 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+# wait for this many seconds without new events before reporting a batch of changes
+DEBOUNCE = float(os.environ.get('ASE_WATCH_DEBOUNCE', 0.5))
+# but report a batch at least this often while files keep changing
+MAX_DELAY = 5.0
+# how often the polling fallback rescans the tree
+POLL_INTERVAL = float(os.environ.get('ASE_WATCH_POLL_INTERVAL', 2.0))
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+# struct inotify_event: wd, mask, cookie, len, then len bytes of NUL-padded name
+_EVENT = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    """
+    Watches a directory tree with Linux inotify, through ctypes.  Every directory that
+    `indexable` scans gets a watch; directories created or moved into the tree are
+    watched as they appear, and the files already in them are reported as changed.
+    """
+
+    def __init__(self, indexable):
+        self._indexable = indexable
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._directories = {}  # watch descriptor -> directory
+        try:
+            self._watch_tree(indexable.root)
+        except OSError:
+            self.close()
+            raise
+
+    def _watch_tree(self, top):
+        """Watch top and the directories under it; returns the files found in them."""
+        files = []
+        for directory, subdirs, names in os.walk(top):
+            subdirs[:] = [name for name in subdirs if self._indexable.directory(os.path.join(directory, name))]
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise OSError(error, 'Out of inotify watches; raise fs.inotify.max_user_watches')
+                # the directory was removed before we got to it
+                continue
+            self._directories[wd] = directory
+            files.extend(os.path.join(directory, name) for name in names)
+        return files
+
+    def _unwatch_tree(self, top):
+        for wd, directory in list(self._directories.items()):
+            if directory == top or directory.startswith(top + os.sep):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._directories[wd]
+
+    def read(self, timeout=None):
+        """
+        Wait up to `timeout` seconds (forever if None) for events, and return the set of
+        paths they affect: empty if nothing happened, or None if the kernel dropped events.
+        """
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+        changed = set()
+        overflow = False
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+                offset += _EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                if mask & IN_IGNORED:
+                    self._directories.pop(wd, None)
+                    continue
+                directory = self._directories.get(wd)
+                if directory is None or not name:
+                    continue
+                path = os.path.join(directory, os.fsdecode(name))
+                changed.add(path)
+                if mask & IN_ISDIR:
+                    if mask & IN_MOVED_FROM:
+                        # the watches would keep reporting the old paths
+                        self._unwatch_tree(path)
+                    if mask & (IN_CREATE | IN_MOVED_TO) and self._indexable.directory(path):
+                        changed.update(self._watch_tree(path))
+        return None if overflow else changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """
+    Finds changes by rescanning the tree every POLL_INTERVAL seconds and comparing each
+    indexable file's size and mtime, for platforms without inotify.
+    """
+
+    def __init__(self, list_files, interval=POLL_INTERVAL):
+        self._list_files = list_files
+        self._interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for path in self._list_files():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def read(self, timeout=None):
+        time.sleep(self._interval)
+        snapshot = self._scan()
+        changed = {path for path in snapshot.keys() | self._snapshot.keys()
+                   if snapshot.get(path) != self._snapshot.get(path)}
+        self._snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+def open_watcher(indexable, list_files):
+    """
+    Return an inotify watcher for the tree that `indexable` filters, or a polling one if
+    inotify isn't available.  `list_files` lists the indexable files, for polling.
+    """
+    try:
+        return InotifyWatcher(indexable)
+    except (OSError, AttributeError) as e:
+        # AttributeError: the C library has no inotify functions (not Linux)
+        print(f'inotify unavailable ({e}); polling for changes every {POLL_INTERVAL:g}s')
+        return PollingWatcher(list_files)
+
+
+def changes(watcher, debounce=DEBOUNCE, max_delay=MAX_DELAY):
+    """
+    Yield batches of changed paths from the watcher, coalescing events until none have
+    arrived for `debounce` seconds.  A batch of None means events were lost, and the
+    whole tree should be checked.
+    """
+    pending = set()
+    lost = False
+    first = None  # when the first event of the current batch arrived
+    while True:
+        timeout = None
+        if first is not None:
+            timeout = max(0.0, min(debounce, first + max_delay - time.monotonic()))
+        paths = watcher.read(timeout)
+        if paths is None or paths:
+            if first is None:
+                first = time.monotonic()
+            if paths is None:
+                lost = True
+            else:
+                pending |= paths
+            if time.monotonic() - first < max_delay:
+                continue
+        if first is None:
+            continue
+        yield None if lost else pending
+        pending, lost, first = set(), False, None